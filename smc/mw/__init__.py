@@ -4,11 +4,96 @@
 from __future__ import print_function, division
 from __future__ import absolute_import, unicode_literals
 
-from . mw import mwParser as Parser
-from . mw_pre import mw_preParser as PreprocessorParser
-from . semantics import mwSemantics as Semantics
-from . semantics import SemanticsTracer
-from . preprocessor import mw_preSemantics as PreprocessorSemantics
-from . preprocessor import Preprocessor
-from . settings import Settings
-from . mediawiki import MediaWiki, mediawiki
+import sys as _sys
+import importlib as _importlib
+from types import ModuleType as _ModuleType
+
+# The public names, and the submodule and name they come from.  The
+# submodules (and with them the parsers, lxml and grako) are only
+# imported when one of their names is used, so that short-lived
+# processes only pay for what they need.
+_exports = {
+    "Parser": ("mediawiki", "Parser"),
+    "PreprocessorParser": ("preprocessor", "PreprocessorParser"),
+    "Semantics": ("semantics", "mwSemantics"),
+    "SemanticsTracer": ("semantics", "SemanticsTracer"),
+    "PreprocessorSemantics": ("preprocessor", "mw_preSemantics"),
+    "Preprocessor": ("preprocessor", "Preprocessor"),
+    "DirectoryPreprocessor": ("templates", "DirectoryPreprocessor"),
+    "BundlePreprocessor": ("bundle", "BundlePreprocessor"),
+    "TemplateBundle": ("bundle", "TemplateBundle"),
+    "BundleError": ("bundle", "BundleError"),
+    "build_bundle": ("bundle", "build_bundle"),
+    "TreeCache": ("treecache", "TreeCache"),
+    "Settings": ("settings", "Settings"),
+    "Budget": ("budget", "Budget"),
+    "BudgetExceeded": ("budget", "BudgetExceeded"),
+    "LRUCache": ("cache", "LRUCache"),
+    "Backend": ("backend", "Backend"),
+    "TreeBackend": ("backend", "TreeBackend"),
+    "HTMLBackend": ("backend", "HTMLBackend"),
+    "TextBackend": ("backend", "TextBackend"),
+    "JSONBackend": ("backend", "JSONBackend"),
+    "MediaWiki": ("mediawiki", "MediaWiki"),
+    "mediawiki": ("mediawiki", "mediawiki"),
+    "TextSemantics": ("plaintext", "TextSemantics"),
+    "PlainText": ("plaintext", "PlainText"),
+    "plaintext": ("plaintext", "plaintext"),
+    "Links": ("links", "Links"),
+    "links": ("links", "links"),
+}
+
+# Native strings, as Python 2 does not accept unicode names here.
+__all__ = [str(_name) for _name in sorted(_exports)]
+
+
+class _LazyModule(_ModuleType):
+    """The smc.mw package, with the names in _exports as properties
+    that import their submodule on first access.
+
+    Properties are used instead of __getattr__ because some names
+    (mediawiki, plaintext, links) are also submodules, which the
+    import machinery stores in the module dictionary (Python 2) or
+    sets as attribute (Python 3, see _export).  Properties take
+    precedence over that."""
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_exports))
+
+
+def _export(name):
+    module_name, attr = _exports[name]
+
+    def get(self):
+        values = self.__dict__["_values"]
+        try:
+            return values[name]
+        except KeyError:
+            module = _importlib.import_module("." + module_name, self.__name__)
+            value = getattr(module, attr)
+            values[name] = value
+            return value
+
+    def set(self, value):
+        # Python 3 sets the attribute for a submodule on import.  For
+        # names that are both, the export wins.
+        if (isinstance(value, _ModuleType)
+            and value.__name__ == self.__name__ + "." + name):
+            self.__dict__[name] = value
+            return
+        self.__dict__["_values"][name] = value
+
+    return property(get, set)
+
+
+for _name in _exports:
+    setattr(_LazyModule, _name, _export(_name))
+del _name
+
+_module = _LazyModule(__name__, __doc__)
+_module.__dict__.update(_sys.modules[__name__].__dict__)
+_module._values = {}
+# Python 2 clears the globals of a module when it is deleted, which
+# the functions above still use, so keep the original module alive.
+_module._original = _sys.modules[__name__]
+_sys.modules[__name__] = _module
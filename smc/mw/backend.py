@@ -0,0 +1,226 @@
+# Copyright 2013 semantics GmbH
+# Written by Marcus Brinkmann <m.brinkmann@semantics.de>
+
+from __future__ import print_function, division
+from __future__ import absolute_import, unicode_literals
+
+import re
+import sys
+import json
+from collections import OrderedDict
+
+from lxml import etree
+
+try:
+    basestring
+except:
+    basestring = str
+
+HEADING_TAGS = frozenset(["h1", "h2", "h3", "h4", "h5", "h6"])
+# Elements that start a new text block.
+TEXT_BLOCK_TAGS = frozenset(["p", "pre", "div", "center", "blockquote",
+                             "table", "caption", "hr"])
+TEXT_LIST_TAGS = frozenset(["ul", "ol", "dl"])
+TEXT_ITEM_TAGS = frozenset(["li", "dt", "dd"])
+TEXT_CELL_TAGS = frozenset(["td", "th"])
+WHITESPACE_RE = re.compile(r"\s+", re.UNICODE)
+
+
+class Backend(object):
+    """Converts the document tree built by the semantics into an
+    output format.
+
+    The class attributes tell the semantics which of the passes that
+    only matter for HTML output are needed."""
+
+    # Generate a table of contents.
+    toc = True
+    # Add edit section links to headings.
+    edit_links = True
+
+    def render(self, tree):
+        raise NotImplementedError()
+
+
+class TreeBackend(Backend):
+    """The lxml HTML tree itself."""
+
+    def render(self, tree):
+        return tree
+
+
+class HTMLBackend(Backend):
+    """The HTML tree serialized to a string."""
+
+    def render(self, tree):
+        if sys.version < '3':
+            return etree.tostring(tree)
+        return etree.tostring(tree, encoding=str)
+
+
+class _TextWriter(object):
+    def __init__(self):
+        # List of (kind, text), kind is "block", "item" or "row".
+        self.blocks = []
+        self.inline = []
+        # Stack of [tag, count] for the enclosing lists.
+        self.lists = []
+        self.prefix = ""
+        # The cells of the current table row.
+        self.row = None
+        self.cell = 0
+        self.pre = 0
+
+    def _take_inline(self):
+        text = "".join(self.inline)
+        self.inline = []
+        if self.pre == 0:
+            text = WHITESPACE_RE.sub(" ", text)
+        return text.strip()
+
+    def flush(self, kind="block"):
+        text = self._take_inline()
+        if text != "":
+            self.blocks.append((kind, self.prefix + text))
+        self.prefix = ""
+
+    def children(self, el):
+        if el.text is not None:
+            self.inline.append(el.text)
+        for child in el:
+            self.element(child)
+            if child.tail is not None:
+                self.inline.append(child.tail)
+
+    def element(self, el):
+        tag = el.tag
+        if not isinstance(tag, basestring):
+            # Comments and processing instructions.
+            return
+        cls = el.get("class")
+        if ((tag == "sup" and cls == "reference")
+                or (tag == "span" and cls in ("mw-editsection", "mw-cite-backlink"))
+                or (tag == "div" and cls == "toc")):
+            return
+
+        if self.cell > 0:
+            # Cells are kept on one line.
+            if tag == "br" or tag in TEXT_BLOCK_TAGS or tag in TEXT_ITEM_TAGS:
+                self.inline.append(" ")
+            self.children(el)
+        elif tag == "br":
+            self.inline.append("\n" if self.pre else " ")
+        elif tag in TEXT_CELL_TAGS:
+            inline = self.inline
+            self.inline = []
+            self.cell = self.cell + 1
+            self.children(el)
+            self.cell = self.cell - 1
+            text = self._take_inline()
+            self.inline = inline
+            if self.row is None:
+                self.inline.append(" " + text + " ")
+            else:
+                self.row.append(text)
+        elif tag == "tr":
+            self.flush(self._kind())
+            row = self.row
+            self.row = []
+            self.children(el)
+            # Text directly in the row is dropped, like browsers do.
+            self.inline = []
+            if any(self.row):
+                self.blocks.append(("row", "\t".join(self.row)))
+            self.row = row
+        elif tag in HEADING_TAGS or tag in TEXT_BLOCK_TAGS:
+            self.flush(self._kind())
+            if tag == "pre":
+                self.pre = self.pre + 1
+                self.children(el)
+                self.flush()
+                self.pre = self.pre - 1
+            else:
+                self.children(el)
+                self.flush(self._kind())
+        elif tag in TEXT_LIST_TAGS:
+            self.flush(self._kind())
+            self.lists.append([tag, 0])
+            self.children(el)
+            self.flush("item")
+            self.lists.pop()
+        elif tag in TEXT_ITEM_TAGS:
+            self.flush("item")
+            indent = "  " * max(len(self.lists) - 1, 0)
+            if len(self.lists) > 0 and self.lists[-1][0] == "ol":
+                self.lists[-1][1] = self.lists[-1][1] + 1
+                self.prefix = indent + "%d. " % self.lists[-1][1]
+            elif len(self.lists) > 0 and self.lists[-1][0] == "ul":
+                self.prefix = indent + "* "
+            elif tag == "dd":
+                self.prefix = indent + "  "
+            else:
+                self.prefix = indent
+            self.children(el)
+            self.flush("item")
+        else:
+            self.children(el)
+
+    def _kind(self):
+        return "item" if len(self.lists) > 0 else "block"
+
+    def text(self):
+        self.flush(self._kind())
+        output = []
+        last_kind = None
+        for kind, text in self.blocks:
+            if last_kind is not None:
+                same = (kind == last_kind and kind != "block")
+                output.append("\n" if same else "\n\n")
+            output.append(text)
+            last_kind = kind
+        if len(output) > 0:
+            output.append("\n")
+        return "".join(output)
+
+
+class TextBackend(Backend):
+    """Plain text, for example for search indexing.
+
+    Paragraphs, headings and tables are separated by empty lines,
+    list items are prefixed by bullets or numbers, and table cells
+    are separated by tabs.  Footnote markers and edit links are
+    dropped, the reference lists are kept as numbered lists."""
+
+    toc = False
+    edit_links = False
+
+    def render(self, tree):
+        writer = _TextWriter()
+        writer.children(tree.find("body"))
+        return writer.text()
+
+
+def tree_to_data(el):
+    """Return el as nested lists [tag, attributes, child...], where
+    text content is given as strings and attributes is omitted if
+    empty."""
+    node = [el.tag]
+    if len(el.attrib) > 0:
+        node.append(OrderedDict(el.attrib.items()))
+    if el.text is not None:
+        node.append(el.text)
+    for child in el:
+        if isinstance(child.tag, basestring):
+            node.append(tree_to_data(child))
+        if child.tail is not None:
+            node.append(child.tail)
+    return node
+
+
+class JSONBackend(Backend):
+    """A compact JSON representation of the HTML tree, see
+    tree_to_data."""
+
+    def render(self, tree):
+        return json.dumps(tree_to_data(tree), ensure_ascii=False,
+                          separators=(",", ":"))
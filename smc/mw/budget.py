@@ -0,0 +1,97 @@
+# Copyright 2013 semantics GmbH
+# Written by Marcus Brinkmann <m.brinkmann@semantics.de>
+
+from __future__ import print_function, division
+from __future__ import absolute_import, unicode_literals
+
+import time
+
+try:
+    _clock = time.monotonic
+except AttributeError:
+    _clock = time.time
+
+try:
+    RecursionError = RecursionError
+except NameError:
+    # Python 2 raises a plain RuntimeError.
+    RecursionError = RuntimeError
+
+
+class BudgetExceeded(Exception):
+    """The render ran out of its wall-clock or step budget."""
+
+
+class Budget(object):
+    """A per-render budget of wall-clock time and grammar rule
+    invocations.
+
+    The parsers charge one step for every rule invocation, the
+    preprocessor and the semantics only call check().  Reading the
+    clock is comparatively expensive, so it is only done every
+    check_interval calls."""
+
+    def __init__(self, timeout=None, max_steps=None, check_interval=1000):
+        if timeout is None:
+            self.deadline = None
+        else:
+            self.deadline = _clock() + timeout
+        self.max_steps = max_steps
+        self.check_interval = check_interval
+        self.steps = 0
+        self._countdown = check_interval
+
+    def step(self):
+        self.steps = self.steps + 1
+        max_steps = self.max_steps
+        if max_steps is not None and self.steps > max_steps:
+            raise BudgetExceeded("step budget of %d exceeded" % max_steps)
+        self.check()
+
+    def check(self):
+        self._countdown = self._countdown - 1
+        if self._countdown > 0:
+            return
+        self._countdown = self.check_interval
+        if self.deadline is not None and _clock() > self.deadline:
+            raise BudgetExceeded("deadline exceeded")
+
+
+class _ChargedRuleStack(list):
+    """The rule stack of a budgeted parser, which charges a step for
+    every rule pushed on it.
+
+    Grako pushes the name of every rule it invokes, so this charges
+    the budget without wrapping _call, which would add a Python frame
+    to every rule invocation and let deeply nested input hit the
+    recursion limit sooner."""
+
+    def __init__(self, budget):
+        list.__init__(self)
+        self.step = budget.step
+
+    def append(self, name):
+        self.step()
+        list.append(self, name)
+
+
+class BudgetedParser(object):
+    """Mixin for grako parsers that charges every rule invocation to
+    the budget in the budget attribute (if any).
+
+    Running into the recursion limit is reported as BudgetExceeded,
+    too.  Without a budget, rule invocations take the plain code path,
+    so the mixin costs no time."""
+
+    budget = None
+
+    def _reset(self, *args, **kwargs):
+        super(BudgetedParser, self)._reset(*args, **kwargs)
+        if self.budget is not None:
+            self._rule_stack = _ChargedRuleStack(self.budget)
+
+    def parse(self, *args, **kwargs):
+        try:
+            return super(BudgetedParser, self).parse(*args, **kwargs)
+        except RecursionError:
+            raise BudgetExceeded("recursion limit exceeded")
@@ -0,0 +1,220 @@
+# Copyright 2013 semantics GmbH
+# Written by Marcus Brinkmann <m.brinkmann@semantics.de>
+
+"""Template bundles hold all templates of a wiki in a single file,
+optionally with their preprocessor trees, so that they are quick to
+copy and to open, and workers need not parse the templates again.
+The bundle is mapped read-only, so all processes on a host that use
+it share one copy in the page cache.
+
+A bundle starts with HEADER (the magic, the format version, and the
+offset and size of the index), followed by the template texts and
+trees, and then the index.  The index is a JSON object with the
+TREE_VERSION of the trees and, by page name, the offset and size of
+the text and of the tree (0 and 0 without a tree).  Texts are UTF-8,
+trees are serialized with tree_to_bytes."""
+
+from __future__ import print_function, division
+from __future__ import absolute_import, unicode_literals
+
+import os
+import sys
+import time
+import json
+import mmap
+import struct
+import tempfile
+
+from . preprocessor import Preprocessor, TREE_VERSION
+from . preprocessor import tree_to_bytes, tree_from_bytes
+from . templates import scan_directory, WATCH_INTERVAL
+from . cache import LRUCache
+
+MAGIC = b"MWTB"
+FORMAT_VERSION = 1
+HEADER = struct.Struct(">4sIQQ")
+
+
+class BundleError(Exception):
+    """The file is not a template bundle this version can read."""
+
+
+def build_bundle(path, template_dir, trees=True, settings=None):
+    """Write the templates in TEMPLATE_DIR (see DirectoryPreprocessor)
+    to the bundle PATH, with their preprocessor trees unless TREES is
+    false.  Return the number of templates.
+
+    The bundle is replaced atomically, so that processes which have
+    the old bundle open can keep using it."""
+    if isinstance(template_dir, bytes):
+        template_dir = template_dir.decode(sys.getfilesystemencoding())
+    files, _ = scan_directory(template_dir)
+    preprocessor = Preprocessor(settings=settings)
+    index = {}
+    # Written under a temporary name in the same directory, so that
+    # the rename is atomic.  mkstemp creates the file readable only by
+    # its owner, but the bundle is shared with other users.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".")
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(HEADER.pack(MAGIC, FORMAT_VERSION, 0, 0))
+            for name in sorted(files.keys()):
+                with open(files[name], "rb") as template_fh:
+                    data = template_fh.read()
+                entry = [fh.tell(), len(data), 0, 0]
+                fh.write(data)
+                if trees:
+                    try:
+                        tree = preprocessor.parse(data.decode("UTF-8"))
+                    except Exception:
+                        # Left to the loader, which fails the same way.
+                        tree = None
+                    if tree is not None:
+                        data = tree_to_bytes(tree)
+                        entry[2:] = [fh.tell(), len(data)]
+                        fh.write(data)
+                index[name] = entry
+            data = json.dumps({"tree_version": TREE_VERSION if trees else None,
+                               "templates": index},
+                              ensure_ascii=False, sort_keys=True).encode("UTF-8")
+            index_offset = fh.tell()
+            fh.write(data)
+            fh.seek(0)
+            fh.write(HEADER.pack(MAGIC, FORMAT_VERSION, index_offset, len(data)))
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+    return len(index)
+
+
+class TemplateBundle(object):
+    """A template bundle, mapped into memory.  Only the index is read
+    when it is opened, the templates are read on demand."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as fh:
+            st = os.fstat(fh.fileno())
+            if st.st_size < HEADER.size:
+                raise BundleError("not a template bundle: " + path)
+            self._map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self._stat = (st.st_ino, st.st_mtime, st.st_size)
+        magic, version, index_offset, index_size = HEADER.unpack(self._map[:HEADER.size])
+        if magic != MAGIC:
+            raise BundleError("not a template bundle: " + path)
+        if version != FORMAT_VERSION:
+            raise BundleError("unsupported template bundle version {0}: {1}".format(version, path))
+        index = json.loads(self._map[index_offset:index_offset + index_size].decode("UTF-8"))
+        self._templates = index["templates"]
+        # Trees of another grammar are not used.
+        self.has_trees = index["tree_version"] == TREE_VERSION
+
+    def is_current(self):
+        """Return false if the bundle file was replaced (for example
+        by build_bundle) since it was opened."""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            # Keep using this one until there is a new bundle.
+            return True
+        return (st.st_ino, st.st_mtime, st.st_size) == self._stat
+
+    def __contains__(self, name):
+        return name in self._templates
+
+    def __len__(self):
+        return len(self._templates)
+
+    def names(self):
+        return self._templates.keys()
+
+    def get_text(self, name):
+        offset, size, _, _ = self._templates[name]
+        return self._map[offset:offset + size].decode("UTF-8")
+
+    def get_tree(self, name):
+        """Return the preprocessor tree of NAME, or None if there is
+        none."""
+        _, _, offset, size = self._templates[name]
+        if not self.has_trees or size == 0:
+            return None
+        return tree_from_bytes(self._map[offset:offset + size])
+
+    def close(self):
+        self._map.close()
+
+
+class BundlePreprocessor(Preprocessor):
+    """Reads templates from a template bundle (a TemplateBundle or its
+    path).  Templates are looked up like in DirectoryPreprocessor, and
+    up to CACHE_SIZE decoded texts and trees are kept in LRU caches.
+    These are private to the process, so with many processes a
+    smaller CACHE_SIZE trades time for memory.
+
+    With watch, a replaced bundle file is opened again (checked at
+    most every WATCH_INTERVAL), and the caches are cleared."""
+
+    def __init__(self, bundle=None, cache_size=1024, watch=False, **kwargs):
+        if bundle is not None and not isinstance(bundle, TemplateBundle):
+            bundle = TemplateBundle(bundle)
+        self.bundle = bundle
+        self._watch = watch
+        self._checked = time.time()
+        self._texts = LRUCache(cache_size)
+        self._trees = LRUCache(cache_size)
+        super(BundlePreprocessor, self).__init__(**kwargs)
+
+    def _check_bundle(self):
+        now = time.time()
+        if now - self._checked < WATCH_INTERVAL:
+            return
+        self._checked = now
+        old_bundle = self.bundle
+        if old_bundle.is_current():
+            return
+        try:
+            self.bundle = TemplateBundle(old_bundle.path)
+        except (IOError, BundleError):
+            # Probably replaced again, try later.
+            return
+        # The old mapping is unmapped when it is no longer used.
+        self._texts.clear()
+        self._trees.clear()
+
+    def _find(self, namespace, pagename):
+        bundle = self.bundle
+        if namespace.prefix != "template" or bundle is None:
+            return None
+        if pagename in bundle:
+            return pagename
+        pagename = pagename.lower()
+        if pagename in bundle:
+            return pagename
+        return None
+
+    def get_template(self, namespace, pagename):
+        # Not in parse_template, which must use the same bundle.
+        if self._watch and self.bundle is not None:
+            self._check_bundle()
+        name = self._find(namespace, pagename)
+        if name is None:
+            return super(BundlePreprocessor, self).get_template(namespace, pagename)
+        text = self._texts.get(name)
+        if text is None:
+            text = self.bundle.get_text(name)
+            self._texts[name] = text
+        return text
+
+    def parse_template(self, namespace, pagename, text):
+        name = self._find(namespace, pagename)
+        if name is None:
+            return super(BundlePreprocessor, self).parse_template(namespace, pagename, text)
+        tree = self._trees.get(name)
+        if tree is None:
+            tree = self.bundle.get_tree(name)
+            if tree is None:
+                tree = self.parse(text)
+            self._trees[name] = tree
+        return tree
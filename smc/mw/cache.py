@@ -0,0 +1,49 @@
+# Copyright 2013 semantics GmbH
+# Written by Marcus Brinkmann <m.brinkmann@semantics.de>
+
+from __future__ import print_function, division
+from __future__ import absolute_import, unicode_literals
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """A mapping that keeps at most maxsize entries, dropping the
+    least recently used ones first.
+
+    Only get() and item assignment are supported, which is all the
+    caches in this package need."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        data = self._data
+        try:
+            value = data.pop(key)
+        except KeyError:
+            self.misses = self.misses + 1
+            return default
+        # Move to the end, which is the most recently used.
+        data[key] = value
+        self.hits = self.hits + 1
+        return value
+
+    def __setitem__(self, key, value):
+        data = self._data
+        data.pop(key, None)
+        data[key] = value
+        if len(data) > self.maxsize:
+            data.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        self._data.clear()
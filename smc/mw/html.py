@@ -4,8 +4,12 @@
 from __future__ import print_function, absolute_import, division
 
 import re
+import threading
 from bisect import bisect_left
 from lxml import etree
+
+from . cache import LRUCache
+
 try:
     lxml_no_iter_list = False
     list(etree.ElementDepthFirstIterator(etree.Element("foo"), ["foo"]))
@@ -278,6 +282,44 @@ entity_by_name = {
 }
 
 
+def decode_named_entity(name):
+    name = name.lower()
+    entity = entity_by_name.get(name)
+    if entity is None:
+        return "&" + name + ";"
+    return entity
+
+
+def decode_numbered_entity(number=None, hexnumber=None):
+    if hexnumber is not None:
+        try:
+            return unichr(int(hexnumber, 16))
+        except:
+            return "&#x" + hexnumber + ";"
+    try:
+        return unichr(int(number))
+    except:
+        return "&#" + number + ";"
+
+
+# Entities like the html_entity rule in mw.ebnf.
+entity_re = re.compile(r"&(?:([a-zA-Z0-9]+)|#([0-9]+)|#[xX]([0-9a-fA-F]+));")
+
+
+def _decode_entity_cb(match):
+    name, number, hexnumber = match.groups()
+    if name is not None:
+        return decode_named_entity(name)
+    return decode_numbered_entity(number, hexnumber)
+
+
+def decode_entities(text):
+    """Decode all entities in TEXT, like the html_entity rule would."""
+    if "&" not in text:
+        return text
+    return entity_re.sub(_decode_entity_cb, text)
+
+
 _attr_common = frozenset([
     # HTML
     "id", "class", "style", "lang", "dir", "title",
@@ -366,59 +408,87 @@ _attribute_whitelist = {
 }
 
 
+# The whitelists by (el_name, rdfa, microdata), computed on first use.
+_attribute_whitelists = {}
+
+
 def attribute_whitelist(el_name, rdfa=False, microdata=False):
-    result = _attribute_whitelist.get(el_name, frozenset([]))
-    if rdfa is True:
-        result = result.union(_attr_rdfa)
-    if microdata is True:
-        result = result.union(_attr_microdata)
+    key = (el_name, rdfa is True, microdata is True)
+    result = _attribute_whitelists.get(key, None)
+    if result is None:
+        result = _attribute_whitelist.get(el_name, frozenset([]))
+        if rdfa is True:
+            result = result.union(_attr_rdfa)
+        if microdata is True:
+            result = result.union(_attr_microdata)
+        _attribute_whitelists[key] = result
     return result
 
 
-def css_filter(style):
+# CSS escapes, see css_filter.
+css_decode_re = re.compile(r"\\(?:(\r\n|\n|\r|\f)|([0-9a-fA-F]{1,6}[ \t\n\r\f]?)|(.)|$)")
+css_comments_re = re.compile(r"/\*.*?\*/")
+css_unclosed_comment_re = re.compile(r"/\*.*$")
+css_invalid_control_re = re.compile(r"[\x00-\x08\x0e-\x1f\x7f]")
+# FIXME: Better use whitelist.
+css_insecure_input_re = re.compile(r"expression|filter\s*:|accelerator\s*:|url\s*\(|image\s*\(|image-set\s*\(")
+css_escaped_chars = frozenset(["\n", '"', "'", "\\"])
+
+
+def _css_decode_cb(match):
+    match = match.groups()
+    if match[0]:
+        return ""
+    elif match[1]:
+        try:
+            char = unichr(int(match[1], 16))
+        except:
+            # invalid codepoint
+            char = u"\ufffd"
+    elif match[2]:
+        char = match[2]
+    else:
+        # Backslash at end of string.
+        char = "\\"
+    if char in css_escaped_chars:
+        # If these occur in strings, they must be escaped.
+        return r"\{nr:x} ".format(nr=char)
+    return char
+
+
+def _css_filter(style):
     # FIXME: This should be based on whitelisting instead.
-    decode_re = re.compile(r"\\(?:(\r\n|\n|\r|\f)|([0-9a-fA-F]{1,6}[ \t\n\r\f]?)|(.)|$)")
-
-    def decode_cb(match):
-        match = match.groups()
-        if match[0]:
-            return ""
-        elif match[1]:
-            try:
-                char = unichr(int(match[1], 16))
-            except:
-                # invalid codepoint
-                char = u"\ufffd"
-        elif match[2]:
-            char = match[2]
-        else:
-            # Backslash at end of string.
-            char = "\\"
-        if char in frozenset(["\n", '"', "'", "\\"]):
-            # If these occur in strings, they must be escaped.
-            return r"\{nr:x} ".format(nr=char)
-        return char
-
-    style, _ = decode_re.subn(decode_cb, style)
-
-    comments_re = re.compile(r"/\*.*?\*/")
-    style, _ = comments_re.subn(" ", style)
-
-    unclosed_comment_re = re.compile(r"/\*.*$")
-    style = unclosed_comment_re.sub(" ", style)
+    style = css_decode_re.sub(_css_decode_cb, style)
+    style = css_comments_re.sub(" ", style)
+    style = css_unclosed_comment_re.sub(" ", style)
 
-    invalid_control_re = re.compile(r"[\x00-\x08\x0e-\x1f\x7f]")
-    if invalid_control_re.search(style):
+    if css_invalid_control_re.search(style):
         return '/* invalid control char */'
 
-    # FIXME: Better use whitelist.
-    insecure_input_re = re.compile(r"expression|filter\s*:|accelerator\s*:|url\s*\(|image\s*\(|image-set\s*\(")
-    if insecure_input_re.search(style):
+    if css_insecure_input_re.search(style):
         return '/* insecure input */'
 
     return style
 
 
+# Pages repeat the same style attributes many times (in tables, for
+# example), so the filtered styles are cached.  The cache is shared by
+# all renders, also in other threads, so it is guarded by a lock.  The
+# filtering itself happens outside of the lock.
+css_filter_cache = LRUCache(1024)
+_css_filter_lock = threading.Lock()
+
+
+def css_filter(style):
+    with _css_filter_lock:
+        result = css_filter_cache.get(style)
+    if result is None:
+        result = _css_filter(style)
+        with _css_filter_lock:
+            css_filter_cache[style] = result
+    return result
+
+
 def escape_id(id):
     return id
 
@@ -439,10 +509,12 @@ ITER_POP = 1
 ITER_ADD = 2
 
 
-def iter_structure(root):
-    # Iterate over the headings, returning also the structure.
-    headings = iter_from_list(root, ["h1", "h2", "h3", "h4", "h5", "h6"])
-    headings = list(headings)
+def iter_structure(root, headings=None):
+    # Iterate over the headings, returning also the structure.  The
+    # headings can be given if they were collected already.
+    if headings is None:
+        headings = iter_from_list(root, ["h1", "h2", "h3", "h4", "h5", "h6"])
+        headings = list(headings)
 
     # A stack of toc numbers for the previous element and its ancestors.
     toc_nrs = []
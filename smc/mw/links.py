@@ -0,0 +1,178 @@
+# Copyright 2013 semantics GmbH
+# Written by Marcus Brinkmann <m.brinkmann@semantics.de>
+
+from __future__ import print_function, division
+from __future__ import absolute_import, unicode_literals
+
+import re
+from collections import OrderedDict
+
+from . preprocessor import Preprocessor
+from . html import decode_entities, _attribute_whitelist
+
+# The link rules of mw.ebnf, for text that went through the
+# preprocessor (so comments are already removed).
+LINK_SCHEMES = (r"http://|https://|ftp://|telnet://|irc://|ircs://|nntp://|"
+                r"worldwind://|mailto:|news:|svn://|git://|mms://")
+# The content of these elements is not parsed for links.
+VERBATIM_RE = re.compile(r"<(nowiki|pre)(?![\w])[^>]*?(?:/>|>(.*?)(?:</\1[ \t\n]*>|$))",
+                         re.IGNORECASE | re.DOTALL)
+# The attributes of HTML elements do not contain links.
+HTML_TAG_RE = re.compile(r"(<(?:" + "|".join(sorted(_attribute_whitelist)) +
+                         r"))(?=[\s/>])((?:\"[^\"]*\"|'[^']*'|[^<>\"'])*)>",
+                         re.IGNORECASE)
+# Characters in nowiki that would otherwise be taken for link syntax.
+# The escapes contain "&" and "#", so these come first.
+NOWIKI_ESCAPES = [("&", "&amp;"), ("#", "&#35;"), ("[", "&#91;"),
+                  ("]", "&#93;"), ("|", "&#124;"), (":", "&#58;")]
+# Like MediaWiki, link openings are taken from left to right, so the
+# second and third bracket of "[[[" do not open a link.
+INTERNAL_LINK_RE = re.compile(r"\[\[")
+INTERNAL_TARGET_RE = re.compile(r"[ \t]*([^\[\]\|\n]*?)[ \t]*(\]\]|\|)")
+# Links close at the matching brackets in the same paragraph.
+INTERNAL_NESTING_RE = re.compile(r"\[\[|\]\]|\n\n")
+EXTERNAL_LINK_RE = re.compile(r"\[((?:" + LINK_SCHEMES + r"|//)[^\n\[\] \t]*)")
+PLAIN_LINK_RE = re.compile(r"\b(?:" + LINK_SCHEMES + r")[^\n\[\] \t]*")
+# Trailing interpunctation is not part of the link.  Like in the
+# grammar, this includes parentheses (see more_link_chars).
+LINK_TAIL_CHARS = ",;.:!?()"
+# Characters that can not occur in page names.
+INVALID_TITLE_RE = re.compile(r"[\[\]{}|<>]")
+# Internal links to URLs are not links at all (see MediaWiki's
+# Parser::replaceInternalLinks2).
+URL_TARGET_RE = re.compile(r"(?:" + LINK_SCHEMES + r"|//)", re.IGNORECASE)
+
+
+def category_prefixes(settings):
+    """The namespace prefixes that make a link a category assignment."""
+    return frozenset(["category", settings.get_msg("category").lower()])
+
+
+def link_page(settings, target, prefixes):
+    """Return ("link", page name) or ("category", category name) for
+    the link TARGET (with entities decoded), or None if it does not
+    link to another page.  PREFIXES are the category_prefixes."""
+    if URL_TARGET_RE.match(target) is not None:
+        return None
+    target = target.split("#", 1)[0].strip()
+    if INVALID_TITLE_RE.search(target) is not None:
+        return None
+    colpos = target.find(":")
+    if colpos > 0 and target[:colpos].strip().lower() in prefixes:
+        name = settings.canonical_page_name(target[colpos + 1:])[1]
+        kind = "category"
+    else:
+        # A leading colon links to a category (or image) instead of
+        # using it.
+        if colpos == 0:
+            target = target[1:]
+        namespace, name = settings.canonical_page_name(target)
+        if name != "":
+            name = settings.expand_page_name(namespace, name)
+        kind = "link"
+    if name == "":
+        # A link to a section of the same page, or no page at all.
+        return None
+    return kind, name
+
+
+def _verbatim(match):
+    if match.group(1).lower() == "pre":
+        return " " * len(match.group(0))
+    if match.group(2) is None:
+        # <nowiki/> separates text without adding any.
+        return ""
+    # The text of nowiki is part of link targets, but it is not link
+    # syntax itself.
+    text = match.group(2)
+    for char, entity in NOWIKI_ESCAPES:
+        text = text.replace(char, entity)
+    return text
+
+
+def _find_close(text, pos):
+    """Return the end of the link whose target ends at POS, or -1 if
+    it is not closed in the same paragraph."""
+    depth = 1
+    for match in INTERNAL_NESTING_RE.finditer(text, pos):
+        token = match.group(0)
+        if token == "[[":
+            depth = depth + 1
+        elif token == "]]":
+            depth = depth - 1
+            if depth == 0:
+                return match.end()
+        else:
+            return -1
+    return -1
+
+
+class Links(object):
+    """The outgoing links of a page, for link tables.
+
+    The text is expanded by the preprocessor, but instead of parsing
+    it, the links are found by a scan that follows the link rules of
+    the grammar.  Internal links and categories are canonical page
+    names without fragment, in order of first appearance.  Templates
+    are all pages the preprocessor tried to transclude, whether they
+    exist or not.  Links in nowiki and pre elements and in the
+    attributes of HTML elements are ignored."""
+
+    def __init__(self, wikitext, title=None, budget=None, preprocessor=None):
+        if preprocessor is None:
+            preprocessor = Preprocessor()
+        settings = preprocessor.settings
+        text = preprocessor.expand(title, wikitext, budget=budget)
+        self.templates = list(preprocessor.used_templates.keys())
+        self.links = []
+        self.categories = []
+        self.external_links = []
+
+        text = VERBATIM_RE.sub(_verbatim, text)
+        text = HTML_TAG_RE.sub(lambda m: m.group(1) + " " * len(m.group(2)) + ">", text)
+        self._internal_links(settings, text)
+
+        # Bracketed links first, so their targets are not found again
+        # as plain links.
+        external = OrderedDict()
+        for match in EXTERNAL_LINK_RE.finditer(text):
+            external.setdefault(match.start(1), match.group(1).rstrip(LINK_TAIL_CHARS))
+        text = EXTERNAL_LINK_RE.sub(lambda m: "[" + " " * len(m.group(1)), text)
+        for match in PLAIN_LINK_RE.finditer(text):
+            external.setdefault(match.start(), match.group(0).rstrip(LINK_TAIL_CHARS))
+        for pos in sorted(external.keys()):
+            url = external[pos]
+            if url not in self.external_links:
+                self.external_links.append(url)
+
+    def _internal_links(self, settings, text):
+        prefixes = category_prefixes(settings)
+        for opening in INTERNAL_LINK_RE.finditer(text):
+            match = INTERNAL_TARGET_RE.match(text, opening.end())
+            if match is None:
+                continue
+            if match.group(2) == "|" and _find_close(text, match.end()) < 0:
+                continue
+            page = link_page(settings, decode_entities(match.group(1)), prefixes)
+            if page is None:
+                continue
+            kind, name = page
+            if kind == "category":
+                result = self.categories
+            else:
+                result = self.links
+            if name not in result:
+                result.append(name)
+
+    def as_dict(self):
+        result = OrderedDict()
+        result["links"] = self.links
+        result["categories"] = self.categories
+        result["external_links"] = self.external_links
+        result["templates"] = self.templates
+        return result
+
+
+def links(wikitext, title=None, budget=None):
+    """Return the outgoing links of the wikitext as a dictionary."""
+    return Links(wikitext, title=title, budget=budget).as_dict()
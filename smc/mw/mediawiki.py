@@ -4,12 +4,36 @@
 from __future__ import print_function, division
 from __future__ import absolute_import, unicode_literals
 
+import re
+
 from lxml import etree
 
-from . mw import mwParser as Parser
+from . mw import mwParser
 from . semantics import mwSemantics as Semantics
 from . semantics import SemanticsTracer
 from . preprocessor import Preprocessor
+from . budget import BudgetedParser, BudgetExceeded
+from . backend import HTMLBackend
+
+PARAGRAPH_BREAK_RE = re.compile(r"\n[ \t]*\n")
+
+
+class Parser(BudgetedParser, mwParser):
+    """The MediaWiki grammar parser, which can be limited by a Budget."""
+
+
+def degraded_document(text):
+    """Render TEXT as escaped plain paragraphs, without parsing it."""
+    html = etree.Element("html")
+    body = etree.SubElement(html, "body")
+    for chunk in PARAGRAPH_BREAK_RE.split(text):
+        chunk = chunk.strip("\n")
+        if chunk == "":
+            continue
+        p = etree.SubElement(body, "p")
+        p.text = chunk + "\n"
+        p.tail = "\n"
+    return html
 
 
 class MediaWiki(object):
@@ -17,14 +41,32 @@ class MediaWiki(object):
 
     Parses the provided MediaWiki-style wikitext and renders it to HTML."""
 
-    def __init__(self, wikitext, title=None):
-        """Construct a new MediaWiki object for the given wikitext."""
+    def __init__(self, wikitext, title=None, budget=None, degraded=False,
+                 backend=None):
+        """Construct a new MediaWiki object for the given wikitext.
 
-        wikitext = Preprocessor().expand(title, wikitext)
-        parser = Parser(parseinfo=False,  whitespace='', nameguard=False)
-        ast = parser.parse(wikitext, "document", filename="wikitext",
-                           semantics=Semantics(parser), trace=False,
-                           nameguard=False, whitespace='')
+        If a Budget is given and runs out, or the text nests too
+        deeply for the parser, BudgetExceeded is raised, or, if
+        degraded is true, the text is rendered as plain paragraphs
+        instead.  The backend determines the output of
+        render(), and defaults to a HTMLBackend."""
+
+        if backend is None:
+            backend = HTMLBackend()
+        self.backend = backend
+        text = wikitext
+        try:
+            text = Preprocessor().expand(title, wikitext, budget=budget)
+            parser = Parser(parseinfo=False,  whitespace='', nameguard=False)
+            parser.budget = budget
+            semantics = Semantics(parser, budget=budget, backend=backend)
+            ast = parser.parse(text, "document", filename="wikitext",
+                               semantics=semantics, trace=False,
+                               nameguard=False, whitespace='')
+        except BudgetExceeded:
+            if not degraded:
+                raise
+            ast = degraded_document(text)
         self.ast = ast
 
     def as_string(self):
@@ -35,8 +77,12 @@ class MediaWiki(object):
         """Return the rendered output as element tree."""
         return self.ast
 
+    def render(self):
+        """Return the output of the backend."""
+        return self.backend.render(self.ast)
+
 
-def mediawiki(wikitext, title=None):
+def mediawiki(wikitext, title=None, budget=None, degraded=False):
     """Render the wikitext and return output as HTML string."""
-    mw = MediaWiki(wikitext, title=title)
+    mw = MediaWiki(wikitext, title=title, budget=budget, degraded=degraded)
     return mw.as_string()
@@ -15,7 +15,7 @@ from __future__ import print_function, division, absolute_import, unicode_litera
 from grako.parsing import graken, Parser
 
 
-__version__ = (2014, 7, 26, 12, 12, 8, 5)
+__version__ = (2026, 10, 19, 2, 39, 15, 0)
 
 __all__ = [
     'mwParser',
@@ -1021,7 +1021,7 @@ class mwParser(Parser):
 
     @graken()
     def _non_special_chars_(self):
-        self._pattern(r'((?!(http://|https://|ftp://|telnet://|irc://|ircs://|nntp://|worldwind://|mailto:|news:|svn://|git://|mms://))[^\n\[\]{\'"|=<&!:])+')
+        self._pattern(r'((?!(http://|https://|ftp://|telnet://|irc://|ircs://|nntp://|worldwind://|mailto:|news:|svn://|git://|mms://))[^\n\[\]{\'"|=<&!:]|&([a-zA-Z0-9]+|#[0-9]+|#[xX][0-9a-fA-F]+);)+')
 
     @graken()
     def _paragraph_(self):
@@ -1555,18 +1555,18 @@ class mwParser(Parser):
         def block1():
             with self._choice():
                 with self._option():
-                    self._pattern(r'[^<"&]+')
-                with self._option():
-                    self._html_entity_()
+                    self._html_attribute_text_doublequote_()
                 with self._option():
                     self._nowiki_()
-                with self._option():
-                    self._token('&')
-                self._error('expecting one of: & [^<"&]+')
+                self._error('no available options')
         self._closure(block1)
         self.ast['@'] = self.last_node
         self._token('"')
 
+    @graken()
+    def _html_attribute_text_doublequote_(self):
+        self._pattern(r'[^<"]+')
+
     @graken()
     def _html_attribute_value_singlequote_(self):
         self._token("'")
@@ -1574,31 +1574,21 @@ class mwParser(Parser):
         def block1():
             with self._choice():
                 with self._option():
-                    self._pattern(r"[^<'&]+")
-                with self._option():
-                    self._html_entity_()
+                    self._html_attribute_text_singlequote_()
                 with self._option():
                     self._nowiki_()
-                with self._option():
-                    self._token('&')
-                self._error("expecting one of: & [^<'&]+")
+                self._error('no available options')
         self._closure(block1)
         self.ast['@'] = self.last_node
         self._token("'")
 
     @graken()
-    def _html_attribute_value_noquote_(self):
+    def _html_attribute_text_singlequote_(self):
+        self._pattern(r"[^<']+")
 
-        def block0():
-            with self._choice():
-                with self._option():
-                    self._pattern(r'[a-zA-Z0-9!#$%()*,\-./:;<>?@:[\]^_`{|}~]+')
-                with self._option():
-                    self._html_entity_()
-                with self._option():
-                    self._token('&')
-                self._error('expecting one of: & [a-zA-Z0-9!#$%()*,\\-./:;<>?@:[\\]^_`{|}~]+')
-        self._positive_closure(block0)
+    @graken()
+    def _html_attribute_value_noquote_(self):
+        self._pattern(r'[a-zA-Z0-9!#$%&()*,\-./:;<>?@:[\]^_`{|}~]+')
 
     @graken()
     def _html_attribute_value_(self):
@@ -1807,8 +1797,6 @@ class mwParser(Parser):
             self._check_ifnot_()
             with self._group():
                 with self._choice():
-                    with self._option():
-                        self._html_entity_()
                     with self._option():
                         self._nowiki_non_special_chars_()
                     with self._option():
@@ -1818,7 +1806,7 @@ class mwParser(Parser):
 
     @graken()
     def _nowiki_non_special_chars_(self):
-        self._pattern(r'[^<&]+')
+        self._pattern(r'[^<]+')
 
     @graken()
     def _pre_nowiki_(self):
@@ -1859,8 +1847,6 @@ class mwParser(Parser):
                 self._pattern(r'</pre[ \t\n]*>')
             with self._group():
                 with self._choice():
-                    with self._option():
-                        self._html_entity_()
                     with self._option():
                         self._nowiki_non_special_chars_()
                     with self._option():
@@ -1907,7 +1893,7 @@ class mwParser(Parser):
 
     @graken()
     def _pre_non_special_chars_(self):
-        self._pattern(r'[^<&]+')
+        self._pattern(r'[^<]+')
 
     @graken()
     def _pre_inline_(self):
@@ -1916,8 +1902,6 @@ class mwParser(Parser):
             self._check_ifnot_()
             with self._group():
                 with self._choice():
-                    with self._option():
-                        self._html_entity_()
                     with self._option():
                         self._pre_nowiki_()
                     with self._option():
@@ -2864,9 +2848,15 @@ class mwSemantics(object):
     def html_attribute_value_doublequote(self, ast):
         return ast
 
+    def html_attribute_text_doublequote(self, ast):
+        return ast
+
     def html_attribute_value_singlequote(self, ast):
         return ast
 
+    def html_attribute_text_singlequote(self, ast):
+        return ast
+
     def html_attribute_value_noquote(self, ast):
         return ast
 
@@ -0,0 +1,171 @@
+# Copyright 2013 semantics GmbH
+# Written by Marcus Brinkmann <m.brinkmann@semantics.de>
+
+from __future__ import print_function, division
+from __future__ import absolute_import, unicode_literals
+
+from collections import OrderedDict
+
+from lxml import etree
+
+from . semantics import mwSemantics, PostprocessSites, is_attached, BROKEN_TARGET
+from . backend import TextBackend, _TextWriter
+from . preprocessor import Preprocessor
+from . mediawiki import Parser
+from . links import category_prefixes, link_page
+
+
+def remove_keep_tail(el):
+    """Remove EL from its parent, but keep its tail text."""
+    parent = el.getparent()
+    tail = el.tail
+    if tail is not None:
+        prev = el.getprevious()
+        if prev is not None:
+            prev.tail = (prev.tail or "") + tail
+        else:
+            parent.text = (parent.text or "") + tail
+    parent.remove(el)
+
+
+def element_text(el):
+    writer = _TextWriter()
+    writer.children(el)
+    return writer.text().strip()
+
+
+class TextSemantics(mwSemantics):
+    """Semantics for plain text extraction.
+
+    Attributes are not sanitized (they are dropped), links are not
+    resolved, there is no table of contents, and references are not
+    numbered but collected.  After parsing, the fields attribute holds
+    the sections, links, categories and reference texts."""
+
+    def __init__(self, context, settings=None, headings=None, budget=None):
+        super(TextSemantics, self).__init__(context, settings=settings,
+                                            headings=headings, budget=budget,
+                                            backend=TextBackend())
+        self._category_prefixes = category_prefixes(self.settings)
+        # Links by input position, see _register_site.
+        self._links = []
+        self.fields = None
+
+    def _set_attributes(self, el, attribs):
+        pass
+
+    def internal_link(self, ast):
+        target = self._link_target(ast)
+        page = None
+        if target != BROKEN_TARGET:
+            page = link_page(self.settings, target, self._category_prefixes)
+        if page is not None and page[0] == "category":
+            # A category assignment, which is not part of the text.
+            el = etree.Element("category")
+        else:
+            el = etree.Element("a")
+            self._link_text(el, ast, target)
+        if page is not None:
+            links = self._links
+            links.append((self._context._buffer._pos, len(links), el) + page)
+        return el
+
+    def document(self, ast):
+        html = self._document_tree(ast)
+        sites = PostprocessSites.from_registered(html, self._sites)
+
+        fields = OrderedDict()
+        fields["sections"] = [OrderedDict([("level", int(h_el.tag[1])),
+                                           ("title", element_text(h_el))])
+                              for h_el in sites.headings]
+
+        links = []
+        categories = []
+        # A link is registered where it ends, so links in an image
+        # caption come before the image.  Sorting by the positions of
+        # all enclosing links, outermost first, gives the input order.
+        positions = dict((link[2], link[:2]) for link in self._links)
+
+        def order(link):
+            key = [link[:2]]
+            parent = link[2].getparent()
+            while parent is not None:
+                if parent in positions:
+                    key.append(positions[parent])
+                parent = parent.getparent()
+            key.reverse()
+            return key
+
+        for pos, serial, el, kind, name in sorted(self._links, key=order):
+            if not is_attached(html, el):
+                continue
+            if kind == "link":
+                if name not in links:
+                    links.append(name)
+            elif name not in categories:
+                categories.append(name)
+        fields["links"] = links
+        fields["categories"] = categories
+
+        # The texts of all references, in order of first use.  Named
+        # references are only listed once.
+        references = []
+        names = {}
+        refs = sites.refs + [ref for references_el in sites.references
+                             for ref in references_el.iter("ref")]
+        for ref in refs:
+            text = element_text(ref)
+            name = ref.get("name")
+            if name is not None:
+                if name in names:
+                    if references[names[name]] == "":
+                        references[names[name]] = text
+                    continue
+                names[name] = len(references)
+            references.append(text)
+        fields["references"] = [text for text in references if text != ""]
+        for el in sites.refs + sites.references:
+            if is_attached(html, el):
+                remove_keep_tail(el)
+
+        self.fields = fields
+        return html
+
+
+class PlainText(object):
+    """Plain text and structured fields of a page, for example for
+    search indexing.
+
+    This is faster than rendering HTML, see TextSemantics."""
+
+    def __init__(self, wikitext, title=None, budget=None, preprocessor=None):
+        if preprocessor is None:
+            preprocessor = Preprocessor()
+        text = preprocessor.expand(title, wikitext, budget=budget)
+        parser = Parser(parseinfo=False, whitespace='', nameguard=False)
+        parser.budget = budget
+        semantics = TextSemantics(parser, settings=preprocessor.settings,
+                                  budget=budget)
+        tree = parser.parse(text, "document", filename="wikitext",
+                            semantics=semantics, trace=False,
+                            nameguard=False, whitespace='')
+        self.text = semantics.backend.render(tree)
+        fields = semantics.fields
+        self.sections = fields["sections"]
+        self.links = fields["links"]
+        self.categories = fields["categories"]
+        self.references = fields["references"]
+
+    def as_dict(self):
+        result = OrderedDict()
+        result["text"] = self.text
+        result["sections"] = self.sections
+        result["links"] = self.links
+        result["categories"] = self.categories
+        result["references"] = self.references
+        return result
+
+
+def plaintext(wikitext, title=None, budget=None):
+    """Return the wikitext as normalized plain text."""
+    return PlainText(wikitext, title=title, budget=budget).text
@@ -5,6 +5,7 @@ from __future__ import print_function, division
 from __future__ import absolute_import, unicode_literals
 
 import itertools
+import hashlib
 from collections import OrderedDict
 import re
 from copy import deepcopy
@@ -17,18 +18,46 @@ import sys
 
 from grako.exceptions import FailedSemantics
 
-from . mw_pre import mw_preParser as PreprocessorParser
+from . mw_pre import mw_preParser, __version__ as mw_pre_version
 from . settings import Settings
 from . semstate import SemanticsState
+from . budget import BudgetedParser
 
 AUTO_NEWLINE_RE = re.compile(r"(?:{\||[:;#*])")
 
+# Identifies the preprocessor trees built by this version, for trees
+# that are stored outside of the process.  The first part changes
+# with the generated grammar, increment the second part when
+# mw_preSemantics changes the trees it builds.
+TREE_VERSION = "{0}-{1}".format(".".join(str(part) for part in mw_pre_version), 1)
+
+# Trees can be deeper than lxml allows by default.
+TREE_PARSER = etree.XMLParser(huge_tree=True)
+
+
+def tree_to_bytes(tree):
+    """Serialize a preprocessor tree (see tree_from_bytes)."""
+    return etree.tostring(tree, encoding="UTF-8", xml_declaration=False)
+
+
+def tree_from_bytes(data):
+    return etree.fromstring(data, TREE_PARSER)
+
+
+def tree_key(text):
+    """The key of the tree of TEXT in Settings.tree_cache."""
+    return hashlib.sha1(text.encode("UTF-8")).hexdigest()
+
 try:
     basestring
 except:
     basestring = str
 
 
+class PreprocessorParser(BudgetedParser, mw_preParser):
+    """The preprocessor grammar parser, which can be limited by a Budget."""
+
+
 class ParserFuncArguments(object):
     """Wrapping arguments for a parser function invocation."""
 
@@ -295,15 +324,97 @@ class mw_preSemantics(object):
         return ast
 
 
+class CallStack(object):
+    """Immutable linked list of the titles of the frames being expanded.
+
+    Pushing a title shares the tail with the parent, so entering a
+    template costs constant time and memory regardless of the depth."""
+
+    __slots__ = ("title", "parent", "depth")
+
+    def __init__(self, title, parent=None):
+        self.title = title
+        self.parent = parent
+        if parent is None:
+            self.depth = 1
+        else:
+            self.depth = parent.depth + 1
+
+    def push(self, title):
+        return CallStack(title, self)
+
+    def __contains__(self, title):
+        node = self
+        while node is not None:
+            if node.title == title:
+                return True
+            node = node.parent
+        return False
+
+    def __len__(self):
+        return self.depth
+
+
+class ExpansionLimits(object):
+    """Running counters for the limits of a single page expansion.
+
+    All frames of one expansion share the same instance, and every
+    check is a constant time increment and compare."""
+
+    def __init__(self, settings, budget=None):
+        self.budget = budget
+        self.max_expand_depth = settings.max_expand_depth
+        self.max_node_count = settings.max_node_count
+        self.max_include_size = settings.max_include_size
+        self.max_expensive_functions = settings.max_expensive_functions
+
+        self.node_count = 0
+        self.include_size = 0
+        self.expensive_function_count = 0
+        # Names of the limits that were exceeded, in order (see
+        # Parser::limitationWarn in MediaWiki).
+        self.warnings = []
+
+    def _warn(self, name):
+        if name not in self.warnings:
+            self.warnings.append(name)
+
+    def check_expand_depth(self, depth):
+        if depth > self.max_expand_depth:
+            self._warn("expansion-depth-exceeded")
+            return False
+        return True
+
+    def increment_node_count(self):
+        self.node_count = self.node_count + 1
+        if self.node_count > self.max_node_count:
+            self._warn("node-count-exceeded")
+            return False
+        return True
+
+    def increment_include_size(self, size):
+        if self.include_size + size > self.max_include_size:
+            self._warn("post-expand-template-inclusion")
+            return False
+        self.include_size = self.include_size + size
+        return True
+
+    def increment_expensive_function_count(self):
+        """Call this from expensive parser functions.  Returns False
+        if the function must not be evaluated."""
+        self.expensive_function_count = self.expensive_function_count + 1
+        if self.expensive_function_count > self.max_expensive_functions:
+            self._warn("expensive-parserfunction")
+            return False
+        return True
+
 
 class PreprocessorFrame(object):
     def __init__(self, context, title, text, include=False, parent=None,
                  named_arguments=None, unnamed_arguments=None,
-                 call_stack=None):
-        parser = context.parser
-        semantics = context.semantics
-        ast = parser.parse(text, "document", semantics=semantics, trace=False,
-                           whitespace='', nameguard=False)
+                 call_stack=None, limits=None, ast=None):
+        if ast is None:
+            ast = context.parse(text)
 
         self.context = context
         self.title = title
@@ -312,9 +423,11 @@ class PreprocessorFrame(object):
         self.parent = parent
         self.named_arguments = named_arguments
         self.unnamed_arguments = unnamed_arguments
-        if call_stack is None:
-            call_stack = set()
+        # The titles of all frames above this one, or None at the root.
         self.call_stack = call_stack
+        if limits is None:
+            limits = ExpansionLimits(context.settings)
+        self.limits = limits
 
     def _get_argument_node(self, name):
         named_arguments = self.named_arguments
@@ -377,12 +490,14 @@ class PreprocessorFrame(object):
                                        list(el.iterchildren("tplarg")))
             parser_func = self.context.expand_parser_func(name[:colon], args)
             if parser_func is not None:
-                return parser_func, None
+                return self._include(name[:colon], parser_func, None)
 
         settings = self.context.settings
         template_ns = settings.namespaces.find("template")
         namespace, pagename = settings.canonical_page_name(name, default_namespace=template_ns)
         template = self.context.get_template(namespace, pagename)
+        self.context.used_templates.setdefault(
+            settings.expand_page_name(namespace, pagename), template is not None)
         if template is None:
             # FIXME.
             return "[[" + settings.expand_page_name(namespace, pagename) + "]]", None
@@ -415,26 +530,45 @@ class PreprocessorFrame(object):
                 if arg_name in named_arguments:
                     del named_arguments[arg_name]
 
-        call_stack = self.call_stack.copy()
         # FIXME: Use canonical page name.
-        call_stack.add(self.title)
+        if self.call_stack is None:
+            call_stack = CallStack(self.title)
+        else:
+            call_stack = self.call_stack.push(self.title)
         # FIXME: Use canonical page name.
         title = "Template:" + name
+        ast = self.context.parse_template(namespace, pagename, template)
         new_frame = PreprocessorFrame(self.context, title,
-                                      template, include=True,
+                                      template, include=True, ast=ast,
                                       parent=self,
                                       named_arguments=named_arguments,
                                       unnamed_arguments=unnamed_arguments,
-                                      call_stack=call_stack)
+                                      call_stack=call_stack,
+                                      limits=self.limits)
         output, headings = new_frame._expand()
         # See MediaWiki bug #529 (and #6255 for problems).
         if not bol and AUTO_NEWLINE_RE.match(output):
             output = "\n" + output
-        return output, headings
+        return self._include(settings.expand_page_name(namespace, pagename),
+                             output, headings)
+
+    def _include(self, name, output, headings):
+        # Account for the post-expand include size (see
+        # Parser::braceSubstitution in MediaWiki).
+        if self.limits.increment_include_size(len(output)):
+            return output, headings
+        return ("[[" + name + "]]<!-- WARNING: template omitted, "
+                "post-expand include size too large -->"), None
 
     def _expand(self, ast=None, recover=False):
-        if self.title in self.call_stack:
-            return '<span class="error">Template loop detected: [[' + self.title + "]]</span>", None
+        limits = self.limits
+        budget = limits.budget
+        call_stack = self.call_stack
+        if call_stack is not None:
+            if self.title in call_stack:
+                return '<span class="error">Template loop detected: [[' + self.title + "]]</span>", None
+            if not limits.check_expand_depth(call_stack.depth):
+                return '<span class="error">Expansion depth limit exceeded</span>', None
 
         def _recover_el(output, event, el):
             if event == "start":
@@ -486,6 +620,12 @@ class PreprocessorFrame(object):
             except StopIteration:
                 break
 
+            if event == "start" and not recover:
+                if not limits.increment_node_count():
+                    return '<span class="error">Node-count limit exceeded</span>', None
+                if budget is not None:
+                    budget.check()
+
             if onlyinclude and not in_onlyinclude:
                 if el.tag == "onlyinclude":
                     if event == "start":
@@ -625,21 +765,56 @@ class Preprocessor(object):
         self.parser = PreprocessorParser(parseinfo=False, whitespace='',
                                          nameguard=False)
         self.semantics = mw_preSemantics(self.parser)
-
-    def _expand(self, title, text):
-        frame = PreprocessorFrame(self, title, text, include=False)
+        # The counters of the most recent expansion, for reporting.
+        self.limits = None
+        # The templates looked up by the most recent expansion, and
+        # if they exist.
+        self.used_templates = OrderedDict()
+
+    def parse(self, text):
+        """Return the preprocessor tree of TEXT.  Expanding a tree
+        does not modify it, so trees can be reused."""
+        tree_cache = self.settings.tree_cache
+        if tree_cache is not None:
+            key = tree_key(text)
+            tree = tree_cache.get(key)
+            if tree is not None:
+                return tree
+        tree = self.parser.parse(text, "document", semantics=self.semantics,
+                                 trace=False, whitespace='', nameguard=False)
+        if tree_cache is not None:
+            tree_cache[key] = tree
+        return tree
+
+    def parse_template(self, namespace, pagename, text):
+        """Return the preprocessor tree of the template TEXT, as
+        returned by get_template.  Subclasses can override this to
+        use trees that are already parsed."""
+        return self.parse(text)
+
+    def _frame(self, title, text, include=False, budget=None):
+        self.limits = ExpansionLimits(self.settings, budget=budget)
+        self.used_templates = OrderedDict()
+        self.parser.budget = budget
+        return PreprocessorFrame(self, title, text, include=include,
+                                 limits=self.limits)
+
+    def _expand(self, title, text, budget=None):
+        frame = self._frame(title, text, include=False, budget=budget)
         return frame._expand()
 
-    def expand(self, title, text):
-        frame = PreprocessorFrame(self, title, text, include=False)
+    def expand(self, title, text, budget=None):
+        """Expand all templates in TEXT.  If BUDGET is given, raise
+        BudgetExceeded when it runs out."""
+        frame = self._frame(title, text, include=False, budget=budget)
         return frame.expand()
 
     def _reconstruct(self, title, text, include=False):
-        frame = PreprocessorFrame(self, title, text, include=include)
+        frame = self._frame(title, text, include=include)
         return frame._expand(recover=True)
 
     def reconstruct(self, title, text, include=False):
-        frame = PreprocessorFrame(self, title, text, include=include)
+        frame = self._frame(title, text, include=include)
         return frame.expand(recover=True)
 
     def get_time(self, utc=False):
@@ -17,10 +17,12 @@ import sys
 from grako.exceptions import FailedSemantics
 from grako.ast import AST
 
-from . mw import mwParser as Parser
-from . html import entity_by_name, attribute_whitelist, css_filter, escape_id
-from . html import ITER_PUSH, ITER_POP, ITER_ADD, iter_structure
+from . html import attribute_whitelist, css_filter, escape_id
+from . html import decode_entities, decode_named_entity, decode_numbered_entity
+from . html import entity_re
+from . html import ITER_PUSH, ITER_POP, ITER_ADD, iter_structure, iter_from_list
 from . settings import Settings
+from . backend import TreeBackend
 from . semstate import SemanticsState
 
 try:
@@ -44,7 +46,145 @@ def tprint(*args, **kwargs):
     print(*args, **kwargs)
 
 
-def postprocess_references(root):
+HEADING_TAGS = frozenset(["h1", "h2", "h3", "h4", "h5", "h6"])
+LEVEL_TAGS = frozenset(["li", "dd", "dt"])
+# Elements that post-processing removes or moves subtrees out of.
+MOVING_TAGS = frozenset(["mw-attr", "ref", "references"])
+# Elements that are registered for post-processing.
+SITE_TAGS = HEADING_TAGS | MOVING_TAGS | frozenset(["toc", "notoc", "forcetoc"])
+# The attributes allowed on ref and references.
+REF_ATTRIBUTES = frozenset(["name", "group"])
+# The target of internal links that _link_target can not handle.
+BROKEN_TARGET = "BROKEN"
+
+
+class UntrimmedText(unicode):
+    """A text run that _trim_inline leaves alone.
+
+    Entities used to be separate inline elements, and _trim_inline
+    only trims the last element unless it is all whitespace.  Runs
+    that end in whitespace after their last entity (or in a whitespace
+    entity) are marked, so the output stays the same."""
+
+
+def is_attached(root, el):
+    """Return true if EL is (still) a descendant of ROOT."""
+    parent = el.getparent()
+    while parent is not None:
+        el = parent
+        parent = el.getparent()
+    return el is root
+
+
+class PostprocessSites(object):
+    """The elements the post-processing passes work on, in document
+    order.
+
+    Usually, the semantic actions register the elements they create
+    (see from_registered), so that the tree needs not be searched.
+    Otherwise, collect() finds them in a single walk over the tree."""
+
+    def __init__(self):
+        self.mw_attrs = []
+        self.levels = []
+        self.refs = []
+        self.references = []
+        self.forcetocs = []
+        self.notocs = []
+        self.tocs = []
+        self.headings = []
+        # True if a TOC relevant element might be moved or removed
+        # by the earlier passes.
+        self.toc_unstable = False
+        # True if elements of the same kind are nested, in which case
+        # the registration order is not the document order.
+        self.nested = False
+
+    @classmethod
+    def from_registered(cls, root, registered):
+        """Create from a list of (pos, serial, el) tuples, where pos
+        is the end position of the element in the input."""
+        sites = cls()
+        for pos, serial, el in sorted(registered, key=lambda site: site[:2]):
+            # Elements from discarded parse alternatives are not
+            # part of the document.
+            if is_attached(root, el):
+                sites.add(el)
+        if sites.nested:
+            sites = cls()
+            sites.collect(root)
+        return sites
+
+    def collect(self, root):
+        for el in root.iter():
+            self.add(el)
+
+    def add(self, el):
+        tag = el.tag
+        if tag == "mw-attr":
+            self.mw_attrs.append(el)
+            if next(el.iterancestors("mw-attr"), None) is not None:
+                self.nested = True
+        elif tag in LEVEL_TAGS:
+            if el.get("level") is not None:
+                self.levels.append(el)
+        elif tag == "ref":
+            # refs inside references only provide referencable
+            # definitions for that group.
+            for ancestor in el.iterancestors("ref", "references"):
+                if ancestor.tag == "references":
+                    return
+                self.nested = True
+            self.refs.append(el)
+        elif tag == "references":
+            self.references.append(el)
+            if next(el.iterancestors("ref", "references"), None) is not None:
+                self.nested = True
+        elif tag in HEADING_TAGS:
+            self._add_toc_site(self.headings, el)
+        elif tag == "toc":
+            self._add_toc_site(self.tocs, el)
+        elif tag == "notoc":
+            self._add_toc_site(self.notocs, el)
+        elif tag == "forcetoc":
+            self._add_toc_site(self.forcetocs, el)
+
+    def _add_toc_site(self, sites, el):
+        sites.append(el)
+        if not self.toc_unstable:
+            for ancestor in el.iterancestors():
+                if ancestor.tag in MOVING_TAGS:
+                    self.toc_unstable = True
+                    break
+
+    def recollect_toc(self, root):
+        """Collect the TOC relevant elements again, if the reference
+        passes may have moved them.  This is rare."""
+        if not self.toc_unstable:
+            return
+        self.forcetocs = list(iter_from_list(root, ["forcetoc"]))
+        self.notocs = list(iter_from_list(root, ["notoc"]))
+        self.tocs = list(iter_from_list(root, ["toc"]))
+        self.headings = list(iter_from_list(root, sorted(HEADING_TAGS)))
+        self.toc_unstable = False
+
+
+def postprocess_attributes(root, mw_attrs):
+    for attr in mw_attrs:
+        el = attr.getparent()
+        # FIXME: This might need some polishing.
+        name = etree.tostring(attr.find("name"), encoding=unicode,
+                              method="text")
+        value = etree.tostring(attr.find("value"), encoding=unicode,
+                               method="text")
+        el.set(name, value)
+        #tail = attr.tail
+        #if tail is not None:
+        #    attr.getparent().text = tail
+        el.remove(attr)
+
+
+def postprocess_references(root, active_refs=None, all_references=None):
     class Anonymous():
         pass
 
@@ -54,7 +194,8 @@ def postprocess_references(root):
 
     # refs inside references only provide referencable definitions for
     # that group, so exclude them here.
-    active_refs = root.xpath(".//ref[not(ancestor::references)]")
+    if active_refs is None:
+        active_refs = root.xpath(".//ref[not(ancestor::references)]")
     for ref in active_refs:
         group = ref.get("group")
         name = ref.get("name")
@@ -95,7 +236,12 @@ def postprocess_references(root):
     refs_as_list = list(refs.values())
 
     # Now generate the reference definition lists.
-    all_references = root.findall(".//references")
+    if all_references is None:
+        all_references = root.findall(".//references")
+    elif len(refs) > 0:
+        # A references element might have been inside a ref.
+        all_references = [references for references in all_references
+                          if is_attached(root, references)]
     for references in all_references:
         group = references.get("group")
         if group not in ref_groups:
@@ -176,8 +322,19 @@ def postprocess_references(root):
 # FIXME: No edit links in preview mode.
 ## preprocesor: Insert a heading marker only for <h> children of <root>
 ## This is to stop extractSections from going over multiple tree levels
-def postprocess_toc(root, settings):
-    structure = list(iter_structure(root))
+def postprocess_toc(root, settings, sites=None):
+    if sites is None:
+        headings = None
+        forcetoc = root.findall(".//forcetoc")
+        notoc = root.findall(".//notoc")
+        tocs = root.findall(".//toc")
+    else:
+        headings = sites.headings
+        forcetoc = sites.forcetocs
+        notoc = sites.notocs
+        tocs = sites.tocs
+
+    structure = list(iter_structure(root, headings))
 
     # Make identifiers unique.
     ids = {}
@@ -193,7 +350,6 @@ def postprocess_toc(root, settings):
                 ids[ident] = 1
 
     # Get forcetoc flag.
-    forcetoc = root.findall(".//forcetoc")
     if len(forcetoc) == 0:
         forcetoc = False
     else:
@@ -202,7 +358,6 @@ def postprocess_toc(root, settings):
         forcetoc = True
 
     # Get notoc flag.
-    notoc = root.findall(".//notoc")
     if len(notoc) == 0:
         notoc = False
     else:
@@ -211,7 +366,6 @@ def postprocess_toc(root, settings):
         notoc = True
 
     # Get first toc element (if any) and remove all others.
-    tocs = root.findall(".//toc")
     for toc in tocs[1:]:
         toc.getparent().remove(toc)
     if len(tocs) == 0:
@@ -291,7 +445,8 @@ def postprocess_toc(root, settings):
             span2.set("class", "toctext")
             # Copy all formatting of the header.
             span2.text = h_el.text
-            span2.extend(deepcopy(h_el))
+            for child in h_el:
+                span2.append(deepcopy(child))
 
             cur_el = li
 
@@ -368,16 +523,40 @@ class mwSemantics(object):
     # Goal: Something like
     # http://www.mediawiki.org/wiki/Parsoid/MediaWiki_DOM_spec
 
-    def __init__(self, context, settings=None, headings=None):
+    def __init__(self, context, settings=None, headings=None, budget=None,
+                 backend=None):
         self._context = context
         if settings is None:
             settings = Settings()
         self.settings = settings
+        # The output backend decides which passes are needed.
+        if backend is None:
+            backend = TreeBackend()
+        self.backend = backend
+        # Rule invocations are charged by the parser, we only check
+        # the deadline during post-processing.
+        self.budget = budget
         # Headings are accessed by end position.
         if headings is None:
             self.headings = None
         else:
             self.headings = dict([(h["end"], h) for h in headings])
+        # Elements that need post-processing, see _register_site.
+        self._sites = []
+        # Resolved link targets, see _resolve_link.
+        self._link_cache = settings.link_cache
+        if self._link_cache is None:
+            self._link_cache = {}
+        # Links waiting for batch_page_exists, as (el, target).
+        self._pending_links = []
+
+    def _register_site(self, el):
+        """Remember EL for post-processing in document(), if it needs
+        any.  Call this for every element created that might."""
+        tag = el.tag
+        if tag in SITE_TAGS or (tag in LEVEL_TAGS and el.get("level") is not None):
+            sites = self._sites
+            sites.append((self._context._buffer._pos, len(sites), el))
 
     @contextmanager
     def _state(self):
@@ -456,54 +635,67 @@ class mwSemantics(object):
                 raise FailedSemantics("inline ifnot negative lookahead reject")
         return ast
 
-    def document(self, ast):
+    def _document_tree(self, ast):
         html = etree.Element("html")
         body = etree.SubElement(html, "body")
         if isinstance(ast, list):
             pass
         else:
             body.extend(ast.blocks)
+        return html
+
+    def document(self, ast):
+        html = self._document_tree(ast)
+        # Before the TOC copies links from the headings.
+        self._resolve_pending_links()
 
         # Post-processing.
-        el_list = html.findall(".//*[mw-attr]")
-        for el in el_list:
-            attrs = el.findall("mw-attr")
-            for attr in attrs:
-                # FIXME: This might need some polishing.
-                name = etree.tostring(attr.find("name"), encoding=unicode,
-                                      method="text")
-                value = etree.tostring(attr.find("value"), encoding=unicode,
-                                       method="text")
-                el.set(name, value)
-                #tail = attr.tail
-                #if tail is not None:
-                #    attr.getparent().text = tail
-                el.remove(attr)
+        budget = self.budget
+        if budget is not None:
+            budget.check()
+
+        sites = PostprocessSites.from_registered(html, self._sites)
+
+        postprocess_attributes(html, sites.mw_attrs)
+        if len(sites.mw_attrs) > 0:
+            # Removing the attributes may have taken refs with them.
+            sites.refs = [ref for ref in sites.refs if is_attached(html, ref)]
+            sites.references = [references for references in sites.references
+                                if is_attached(html, references)]
 
         # Strip the level attribute from list items, which was only
         # used in constructing the lists.
-        el_list = html.findall(".//li[@level]")
-        el_list += html.findall(".//dd[@level]")
-        el_list += html.findall(".//dt[@level]")
-        for el in el_list:
+        for el in sites.levels:
             el.attrib.pop("level")
 
-        postprocess_references(html)
-        postprocess_toc(html, self.settings)
+        postprocess_references(html, sites.refs, sites.references)
+        if budget is not None:
+            budget.check()
+        if self.backend.toc:
+            sites.recollect_toc(html)
+            postprocess_toc(html, self.settings, sites)
+        else:
+            for el in sites.forcetocs + sites.notocs + sites.tocs:
+                if is_attached(html, el):
+                    el.getparent().remove(el)
 
         return html
 
     def heading(self, ast):
         pos = self._context._buffer._pos
         headings = self.headings
-        if headings is None:
+        if headings is None or not self.backend.edit_links:
             return ast
         heading = headings.get(pos, None)
         if heading is None:
             return ast
 
-        # ast is a h element.
-        ast = deepcopy(ast)
+        # ast is a h element.  The h1-h6 rules are only used here, at
+        # the same position and state, so the element is ours and
+        # can be modified in place.  Only the headline span can be
+        # there already, unless a result was reused after all.
+        if len(ast) > 1:
+            return ast
         span = etree.SubElement(ast, "span")
         span.set("class", "mw-editsection")
 
@@ -536,13 +728,15 @@ class mwSemantics(object):
 
         span = etree.SubElement(el, "span")
         span.text = text
-        ident = etree.tostring(el, encoding=unicode, method="text")
+        # The text content of el, without serializing it.
+        ident = text
         # FIXME: May need various canonical forms:
         # One as link target in toc, one as hint in edit link.
         span.set("class", "mw-headline")
         span.set("id", ident)
 
         el.tail = "\n"
+        self._register_site(el)
         return el
 
     def h6(self, ast):
@@ -571,14 +765,17 @@ class mwSemantics(object):
 
     def toc(self, ast):
         el = etree.Element("toc")
+        self._register_site(el)
         return el
 
     def notoc(self, ast):
         el = etree.Element("notoc")
+        self._register_site(el)
         return el
 
     def forcetoc(self, ast):
         el = etree.Element("forcetoc")
+        self._register_site(el)
         return el
 
     def horizontal_rule_block(self, ast):
@@ -643,9 +840,11 @@ class mwSemantics(object):
         return el
 
     def dl_dd(self, ast):
-        el = deepcopy(ast)
-        el.tag = "dd"
-        return el
+        # A list_li after ":" is only used here (ul_block and ol_block
+        # call it after "*" and "#" or a newline), so it can be
+        # retagged in place.
+        ast.tag = "dd"
+        return ast
 
     def list_li(self, ast):
         el = etree.Element("li")
@@ -856,22 +1055,30 @@ class mwSemantics(object):
             last_el = el[-1]
         else:
             last_el = None
+        # The grammar yields many single characters, so runs of
+        # strings are joined and assigned once.
+        texts = []
         for child in ast:
             if isinstance(child, basestring):
-                text = child
-                if last_el is None:
-                    if el.text is None:
-                        el.text = text
-                    else:
-                        el.text = el.text + text
-                else:
-                    if last_el.tail is None:
-                        last_el.tail = text
-                    else:
-                        last_el.tail = last_el.tail + text
-            else:
-                el.append(child)
-                last_el = child
+                texts.append(child)
+                continue
+            if len(texts) > 0:
+                self._append_text(el, last_el, texts)
+                texts = []
+            el.append(child)
+            last_el = child
+        if len(texts) > 0:
+            self._append_text(el, last_el, texts)
+
+    def _append_text(self, el, last_el, texts):
+        if last_el is None:
+            if el.text is not None:
+                texts.insert(0, el.text)
+            el.text = "".join(texts)
+        else:
+            if last_el.tail is not None:
+                texts.insert(0, last_el.tail)
+            last_el.tail = "".join(texts)
 
     def _trim_inline(self, children):
         # Remove trailing whitespace from a list of inline elements.
@@ -882,6 +1089,8 @@ class mwSemantics(object):
             last_child = children[-1]
             if not isinstance(last_child, basestring):
                 break
+            if isinstance(last_child, UntrimmedText):
+                break
             last_child = last_child.rstrip()
             if last_child == "":
                 children = children[:-1]
@@ -891,6 +1100,9 @@ class mwSemantics(object):
                 break
 
     def _maybe_add_newline(self, content):
+        # Empty strings (such as comments) are not the end.
+        while len(content) > 0 and isinstance(content[-1], basestring) and content[-1] == "":
+            content.pop()
         if len(content) > 0:
             last_el = content[-1]
             if isinstance(last_el, etree._Element):
@@ -924,9 +1136,7 @@ class mwSemantics(object):
         el.tail = "\n"
         return el
 
-    def internal_link(self, ast):
-        settings = self.settings
-        el = etree.Element("a")
+    def _link_target(self, ast):
         try:
             # FIXME: target could be arbitrary complicated, need to
             # extract the text from the XML representation.
@@ -934,25 +1144,11 @@ class mwSemantics(object):
             # it with XSL text() later.
             # THIS CAN FAIL AT RUNTIME IF NOT ALL CHILD ELEMENTS ARE
             # STRING(ABLE)!
-            target = "".join(ast.target).strip()
+            return "".join(ast.target).strip()
         except:
-            target = "BROKEN"
-        name = settings.canonical_page_name(target)
-        exists = settings.test_page_exists(name)
-        title = settings.expand_page_name(name[0], name[1])
-        cls = None
-        if exists:
-            url = settings.make_url(name)
-        else:
-            url = settings.make_url(name, action="edit", redlink="1")
-            title = settings.expand_page_name(*name) + " (" + settings.get_msg("missing") + ")"
-            cls = "new"
+            return BROKEN_TARGET
 
-        # Order of attributes matters for tests.
-        el.set("href", url)
-        if cls is not None:
-            el.set("class", cls)
-        el.set("title", title)
+    def _link_text(self, el, ast, target):
         self._trim_inline(ast.text)
         if ast.text and len(ast.text) > 0:
             inline = ast.text
@@ -963,6 +1159,72 @@ class mwSemantics(object):
             el.text = target + ast.suffix
         else:
             el.text = target
+
+    def _resolve_link(self, target):
+        """Return (namespace, pagename, url, title, exists) for the
+        link target.  Pages link to the same targets many times (and
+        the parser may run the semantic action more than once), so
+        the result is cached."""
+        link = self._link_cache.get(target)
+        if link is not None:
+            return link
+        name = self.settings.canonical_page_name(target)
+        link = self._make_link(name, self.settings.test_page_exists(name))
+        self._link_cache[target] = link
+        return link
+
+    def _make_link(self, name, exists):
+        settings = self.settings
+        title = settings.expand_page_name(name[0], name[1])
+        if exists:
+            url = settings.make_url(name)
+        else:
+            url = settings.make_url(name, action="edit", redlink="1")
+            title = title + " (" + settings.get_msg("missing") + ")"
+        return (name[0], name[1], url, title, exists)
+
+    def _set_link(self, el, link):
+        namespace, pagename, url, title, exists = link
+        # Order of attributes matters for tests.
+        el.set("href", url)
+        if not exists:
+            el.set("class", "new")
+        el.set("title", title)
+
+    def _resolve_pending_links(self):
+        """Set the attributes of the links deferred by
+        batch_page_exists, with one test_pages_exist call."""
+        pending = self._pending_links
+        if len(pending) == 0:
+            return
+        settings = self.settings
+        cache = self._link_cache
+        targets = OrderedDict()
+        names = OrderedDict()
+        for el, target in pending:
+            if target not in targets:
+                name = settings.canonical_page_name(target)
+                key = (name[0].prefix, name[1])
+                targets[target] = key
+                names[key] = name
+        exists = dict(zip(names.keys(),
+                          settings.test_pages_exist(list(names.values()))))
+        for target, key in targets.items():
+            cache[target] = self._make_link(names[key], exists[key])
+        for el, target in pending:
+            self._set_link(el, cache[target])
+        self._pending_links = []
+
+    def internal_link(self, ast):
+        el = etree.Element("a")
+        target = self._link_target(ast)
+        link = self._link_cache.get(target)
+        if link is None and self.settings.batch_page_exists:
+            # The attributes are set in document().
+            self._pending_links.append((el, target))
+        else:
+            self._set_link(el, link or self._resolve_link(target))
+        self._link_text(el, ast, target)
         return el
 
     def push_ifnot_intlink_target(self, ast):
@@ -1040,33 +1302,46 @@ class mwSemantics(object):
         return b_el
 
     def comment(self, ast):
-        return None
+        # The preprocessor removes comments, except the warnings it
+        # adds itself.  These are dropped like other comments.
+        return ""
+
+    def html_attribute_text_doublequote(self, ast):
+        return decode_entities(ast)
+
+    def html_attribute_text_singlequote(self, ast):
+        return decode_entities(ast)
+
+    def html_attribute_value_noquote(self, ast):
+        return decode_entities(ast)
 
     def html_attribute_value(self, ast):
+        if isinstance(ast, basestring):
+            return ast
         return "".join(ast)
 
     def _set_attributes(self, el, attribs):
         if attribs is None:
             return
-        if el.tag == "ref" or el.tag == "references":
-            whitelist = frozenset(["name", "group"])
+        tag = el.tag
+        if tag == "ref" or tag == "references":
+            whitelist = REF_ATTRIBUTES
         else:
-            whitelist = attribute_whitelist(el.tag)
+            settings = self.settings
+            whitelist = attribute_whitelist(tag, settings.rdfa, settings.microdata)
         for attrib in attribs:
             name = attrib.name.lower()
             value = attrib.value
-            if name.startswith("data-"):
-                pass
-            elif name not in whitelist:
+            if name in whitelist:
+                # Only whitelisted attributes need filtering.
+                if name == "style":
+                    value = css_filter(value)
+                elif name == "id":
+                    value = escape_id(value)
+                elif name == "role" and value != "presentation":
+                    continue
+            elif not name.startswith("data-"):
                 continue
-            elif name == "role" and value != "presentation":
-                continue
-
-            if name == "style":
-                value = css_filter(value)
-            elif name == "id":
-                value = escape_id(value)
-
             el.set(name, value)
 
     def html_inline(self, ast):
@@ -1082,24 +1357,32 @@ class mwSemantics(object):
         return ast
 
     def html_named_entity(self, ast):
-        name = ast.name.lower()
-        entity = entity_by_name.get(name)
-        if entity is None:
-            return "&" + name + ";"
-        else:
-            return entity
+        return decode_named_entity(ast.name)
 
     def html_numbered_entity(self, ast):
-        if ast.hexnumber is not None:
-            try:
-                return unichr(int(ast.hexnumber, 16))
-            except:
-                return "&#x" + ast.hexnumber + ";"
-        else:
-            try:
-                return unichr(int(ast.number))
-            except:
-                return "&#" + ast.number + ";"
+        return decode_numbered_entity(ast.number, ast.hexnumber)
+
+    def non_special_chars(self, ast):
+        text = decode_entities(ast)
+        if text is ast:
+            return text
+        last = None
+        for last in entity_re.finditer(ast):
+            pass
+        if last is None:
+            return text
+        tail = ast[last.end():]
+        if tail == "":
+            tail = decode_entities(last.group(0))
+        if tail.strip() == "" and text.strip() != "":
+            return UntrimmedText(text)
+        return text
+
+    def nowiki_non_special_chars(self, ast):
+        return decode_entities(ast)
+
+    def pre_non_special_chars(self, ast):
+        return decode_entities(ast)
 
     def nowiki(self, ast):
         # We know for sure that the only list elements are strings.
@@ -1125,6 +1408,7 @@ class mwSemantics(object):
         if ast.content is not None:
             self._collect_blocks(el, ast.content.blocks)
         self._set_attributes(el, ast.attribs)
+        self._register_site(el)
         return el
 
     def html_block(self, ast):
@@ -1132,6 +1416,7 @@ class mwSemantics(object):
         if ast.content is not None:
             self._collect_blocks(el, ast.content.blocks)
         self._set_attributes(el, ast.attribs)
+        self._register_site(el)
         return el
 
     def html_block_no_wspre(self, ast):
@@ -1139,6 +1424,7 @@ class mwSemantics(object):
         if ast.content is not None:
             self._collect_blocks(el, ast.content.blocks)
         self._set_attributes(el, ast.attribs)
+        self._register_site(el)
         return el
 
     def html_p(self, ast):
@@ -0,0 +1,187 @@
+# Copyright 2013 semantics GmbH
+# Written by Marcus Brinkmann <m.brinkmann@semantics.de>
+
+"""Render requests over a stream or a Unix socket, so that many
+small renders can share one warm process (see mw --serve).
+
+Every message is a JSON object encoded as UTF-8, preceded by its
+length as a 4 byte big-endian integer.  A request has the wikitext in
+"text" and optionally the options of process_text ("format",
+"stages", "start", "timeout", "max_steps").  The response has either
+the result in "output", or a message in "error" (and "aborted" set
+to true if the render ran out of its budget)."""
+
+from __future__ import print_function, division
+from __future__ import absolute_import, unicode_literals
+
+import os
+import sys
+import stat
+import json
+import errno
+import socket
+import struct
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+HEADER = struct.Struct(">I")
+# Larger messages are rejected, so that a bad length prefix does not
+# make the reader wait for (and allocate) gigabytes.
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+# Seconds a client may take to send (or receive) a message before it
+# is dropped, so that an idle client does not block the others.
+CONNECTION_TIMEOUT = 60
+
+
+class ProtocolError(Exception):
+    """The peer sent a truncated, malformed or too large message."""
+
+
+class ServerError(Exception):
+    """The socket path can not be used by the server."""
+
+
+def _read_exact(fh, size):
+    chunks = []
+    while size > 0:
+        chunk = fh.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size = size - len(chunk)
+    data = b"".join(chunks)
+    if size > 0 and len(data) > 0:
+        raise ProtocolError("truncated message")
+    return data
+
+
+def read_message(fh):
+    """Return the next message from the binary file FH, or None at
+    the end of the stream."""
+    header = _read_exact(fh, HEADER.size)
+    if len(header) == 0:
+        return None
+    size, = HEADER.unpack(header)
+    if size > MAX_MESSAGE_SIZE:
+        raise ProtocolError("message too large ({0} bytes)".format(size))
+    data = _read_exact(fh, size)
+    if len(data) < size:
+        raise ProtocolError("truncated message")
+    try:
+        return json.loads(data.decode("UTF-8"))
+    except ValueError as exc:
+        raise ProtocolError(str(exc))
+
+
+def write_message(fh, message):
+    data = json.dumps(message, ensure_ascii=False).encode("UTF-8")
+    fh.write(HEADER.pack(len(data)) + data)
+    fh.flush()
+
+
+def serve_stream(handler, infile, outfile):
+    """Answer requests from INFILE on OUTFILE until the end of the
+    stream.  HANDLER maps a request to a response."""
+    while True:
+        request = read_message(infile)
+        if request is None:
+            break
+        write_message(outfile, handler(request))
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        self.timeout = self.server.connection_timeout
+        socketserver.StreamRequestHandler.setup(self)
+
+    def handle(self):
+        try:
+            serve_stream(self.server.handler, self.rfile, self.wfile)
+        except ProtocolError as exc:
+            print("mw: bad request: {0}".format(exc), file=sys.stderr)
+        except socket.timeout:
+            print("mw: client timed out", file=sys.stderr)
+
+    def finish(self):
+        # Errors from a client that went away would replace the
+        # SystemExit raised on SIGTERM while handling its requests.
+        try:
+            socketserver.StreamRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+
+class RenderServer(socketserver.UnixStreamServer):
+    """Answers the requests of one client after another on a Unix
+    socket.  Rendering is CPU bound, so there is nothing to gain from
+    threads.
+
+    While a client is connected, the others wait, so clients should
+    close their connection when done.  A client that sends nothing
+    for TIMEOUT seconds is dropped."""
+
+    def __init__(self, path, handler, timeout=CONNECTION_TIMEOUT):
+        self.handler = handler
+        self.connection_timeout = timeout
+        _remove_stale_socket(path)
+        socketserver.UnixStreamServer.__init__(self, path, _RequestHandler)
+
+    def handle_error(self, request, client_address):
+        # Python 2 passes all exceptions here, but the SystemExit
+        # raised on SIGTERM (see mw --serve) must stop the server.
+        if isinstance(sys.exc_info()[1], (SystemExit, KeyboardInterrupt)):
+            raise
+        socketserver.UnixStreamServer.handle_error(self, request, client_address)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def _remove_stale_socket(path):
+    """Remove the socket at PATH if it is left over from a previous
+    run, that is if nobody listens on it.  Raise ServerError if PATH
+    is something else or still in use."""
+    try:
+        mode = os.stat(path).st_mode
+    except OSError as exc:
+        if exc.errno == errno.ENOENT:
+            return
+        raise
+    if not stat.S_ISSOCK(mode):
+        raise ServerError("not a socket: " + path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error as exc:
+        if exc.errno != errno.ECONNREFUSED:
+            raise
+        os.unlink(path)
+        return
+    finally:
+        sock.close()
+    raise ServerError("socket in use: " + path)
+
+
+class Client(object):
+    """A connection to a RenderServer."""
+
+    def __init__(self, path):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+        self._file = self._sock.makefile("rwb")
+
+    def request(self, message):
+        write_message(self._file, message)
+        response = read_message(self._file)
+        if response is None:
+            raise ProtocolError("connection closed")
+        return response
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
@@ -9,7 +9,9 @@ MSGCAT = {
     "toc": {"en": "Contents",
             "de": "Inhaltsverzeichnis"},
     "missing" : {"en": "page does not exist",
-                 "de": "Seite nicht vorhanden"}
+                 "de": "Seite nicht vorhanden"},
+    "category": {"en": "Category",
+                 "de": "Kategorie"}
 }
 
 
@@ -135,6 +137,11 @@ class Settings(object):
                                       for ns in default_namespaces], lang=lang)
         self.msgcat = MSGCAT
 
+        # wgAllowRdfaAttributes and wgAllowMicrodataAttributes.
+        # Allow the RDFa and microdata attributes on HTML elements.
+        self.rdfa = False
+        self.microdata = False
+
         # wgMaxTocLevel.  This is the maximum heading level that is
         # included in the TOC, assuming that the first heading is h2
         # (h1 is reserved for the page title) and no heading level is
@@ -142,6 +149,36 @@ class Settings(object):
         # first two heading levels are included in the TOC.
         self.max_toc_level = 999
 
+        # Preprocessor limits, see MediaWiki's Manual:Template limits.
+        # wgMaxPPExpandDepth.  Maximum nesting depth of template
+        # expansion.
+        self.max_expand_depth = 40
+        # wgMaxPPNodeCount.  Maximum number of preprocessor nodes
+        # visited while expanding a single page.
+        self.max_node_count = 1000000
+        # wgMaxArticleSize (in characters rather than kilobytes).
+        # Maximum total size of all template and parser function
+        # expansions included in a page.
+        self.max_include_size = 2048 * 1024
+        # wgExpensiveParserFunctionLimit.
+        self.max_expensive_functions = 100
+
+        # Resolved internal link targets, kept across renders if set
+        # to a mapping with get() and item assignment (for example an
+        # LRUCache).  The entries include the result of
+        # test_page_exists, so only use this if that does not change,
+        # or clear the cache when pages are created or deleted.
+        self.link_cache = None
+        # Look up the existence of all linked pages at once with
+        # test_pages_exist after parsing, instead of calling
+        # test_page_exists for every link while parsing.
+        self.batch_page_exists = False
+        # Preprocessor trees by tree_key of their text, if set to a
+        # mapping with get() and item assignment (for example an
+        # LRUCache, or a TreeCache to keep them on disk).  Trees are
+        # not modified when expanded, so they can be shared.
+        self.tree_cache = None
+
     def canonical_page_name(self, name, default_namespace=""):
         """Return the namespace (or None) and the canonical page name."""
         namespace = None
@@ -185,6 +222,12 @@ class Settings(object):
         # pages).
         return True
 
+    def test_pages_exist(self, names):
+        """Return a list of booleans, true for the pages in NAMES
+        ((namespace, name) tuples) that exist.  Override this to look
+        up all pages in one query, see batch_page_exists."""
+        return [self.test_page_exists(name) for name in names]
+
     def make_url(self, name, **kwargs):
         """Create an URL for page NAME (opt. namespace, name tuple).
         KWARGS are GET parameters."""
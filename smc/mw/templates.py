@@ -0,0 +1,116 @@
+# Copyright 2013 semantics GmbH
+# Written by Marcus Brinkmann <m.brinkmann@semantics.de>
+
+from __future__ import print_function, division
+from __future__ import absolute_import, unicode_literals
+
+import os
+import sys
+import time
+
+from . preprocessor import Preprocessor
+from . cache import LRUCache
+
+# With watch, the directories and the cached templates are checked
+# for changes at most this often (in seconds).
+WATCH_INTERVAL = 1.0
+
+
+def scan_directory(template_dir):
+    """Return the template files in TEMPLATE_DIR by page name, where
+    subdirectories hold subpages, and the modification times of the
+    directories."""
+    index = {}
+    dir_mtimes = {}
+    for dirpath, dirnames, filenames in os.walk(template_dir):
+        dir_mtimes[dirpath] = os.stat(dirpath).st_mtime
+        prefix = os.path.relpath(dirpath, template_dir)
+        if prefix == os.curdir:
+            prefix = ""
+        else:
+            prefix = prefix.replace(os.sep, "/") + "/"
+        for filename in filenames:
+            index[prefix + filename] = os.path.join(dirpath, filename)
+    return index, dir_mtimes
+
+
+class DirectoryPreprocessor(Preprocessor):
+    """Reads templates from files named like the page in a directory
+    (subpages in subdirectories).
+
+    The directory is scanned once into an index of file names, and
+    the template texts are kept in an LRU cache, so looking up a
+    template costs no system calls after the first time.  For long
+    running processes, watch picks up changes to the directory and
+    the template files."""
+
+    def __init__(self, template_dir=None, cache_size=1024, watch=False, **kwargs):
+        if isinstance(template_dir, bytes):
+            template_dir = template_dir.decode(sys.getfilesystemencoding())
+        self._template_dir = template_dir
+        self._watch = watch
+        # Lists of [text, mtime, time of last check] by file name.
+        self._templates = LRUCache(cache_size)
+        # File names by page name.
+        self._index = {}
+        # Modification times of the scanned directories.
+        self._dir_mtimes = {}
+        self._checked = time.time()
+        if template_dir is not None:
+            self._scan()
+        super(DirectoryPreprocessor, self).__init__(**kwargs)
+
+    def _scan(self):
+        self._index, self._dir_mtimes = scan_directory(self._template_dir)
+
+    def _check_directories(self):
+        now = time.time()
+        if now - self._checked < WATCH_INTERVAL:
+            return
+        self._checked = now
+        for dirpath, mtime in self._dir_mtimes.items():
+            try:
+                changed = os.stat(dirpath).st_mtime != mtime
+            except OSError:
+                changed = True
+            if changed:
+                self._scan()
+                return
+
+    def _read_template(self, filename):
+        entry = self._templates.get(filename)
+        now = time.time()
+        if entry is not None:
+            if not self._watch or now - entry[2] < WATCH_INTERVAL:
+                return entry[0]
+            try:
+                mtime = os.stat(filename).st_mtime
+            except OSError:
+                mtime = None
+            if mtime == entry[1]:
+                entry[2] = now
+                return entry[0]
+        try:
+            with open(filename, "rb") as fh:
+                mtime = os.fstat(fh.fileno()).st_mtime
+                text = fh.read().decode("UTF-8")
+        except IOError:
+            # Removed since the directory was scanned.
+            return None
+        self._templates[filename] = [text, mtime, now]
+        return text
+
+    def get_template(self, namespace, pagename):
+        if namespace.prefix != "template":
+            return None
+        if self._template_dir is None:
+            return None
+        if self._watch:
+            self._check_directories()
+        index = self._index
+        filename = index.get(pagename, None)
+        if filename is None:
+            filename = index.get(pagename.lower(), None)
+        if filename is not None:
+            return self._read_template(filename)
+        return super(DirectoryPreprocessor, self).get_template(namespace, pagename)
@@ -7,11 +7,11 @@ from __future__ import absolute_import, unicode_literals
 import argparse
 import sys
 import os
+import signal
+import json
 from collections import OrderedDict
 from functools import wraps, partial
-from timeit import Timer
-
-from lxml import etree
+from timeit import Timer, default_timer
 
 import smc.mw as mw
 
@@ -42,40 +42,73 @@ def run_plain(text, filename=None, start=None, profile_data=None,
 
 @profiled("preprocessor")
 def run_preprocessor(text, filename=None, start=None, profile_data=None,
-                     trace=False, preprocessor=None):
-    return (preprocessor or mw.Preprocessor)()._expand(None, text)
+                     trace=False, preprocessor=None, budget=None):
+    return (preprocessor or mw.Preprocessor)()._expand(None, text, budget=budget)
+
+
+@profiled("links")
+def run_links(text, filename=None, start=None, profile_data=None,
+              trace=False, preprocessor=None, budget=None):
+    result = mw.Links(text, preprocessor=(preprocessor or mw.Preprocessor)(),
+                      budget=budget)
+    return json.dumps(result.as_dict(), ensure_ascii=False, indent=2) + "\n"
+
+
+# Output formats, and the name of the backend for each.  text and
+# index use the lighter TextSemantics instead, and links does not run
+# the parser.
+BACKENDS = OrderedDict([
+    ("html", "HTMLBackend"),
+    ("json", "JSONBackend"),
+    ("text", None),
+    ("index", None),
+    ("links", None),
+])
 
 
 @profiled("parser")
 def run_parser(text, filename=None, start=None, profile_data=None,
-               trace=False, headings=None):
+               trace=False, headings=None, budget=None, output_format="html"):
     if start is None:
         start = "document"
     parser = mw.Parser(parseinfo=False, whitespace='', nameguard=False)
+    parser.budget = budget
+    if output_format in ("text", "index"):
+        semantics = mw.TextSemantics(parser, headings=headings, budget=budget)
+    else:
+        semantics = mw.Semantics(parser, headings=headings, budget=budget,
+                                 backend=getattr(mw, BACKENDS[output_format])())
     ast = parser.parse(text, start, filename=filename,
-                       semantics=mw.Semantics(parser, headings=headings), trace=trace,
+                       semantics=semantics, trace=trace,
                        nameguard=False, whitespace='')
-    if sys.version < '3':
-        text = etree.tostring(ast)
-    else:
-        text = etree.tostring(ast, encoding=str)
+    text = semantics.backend.render(ast)
+    if output_format == "index":
+        result = OrderedDict([("text", text)])
+        result.update(semantics.fields)
+        text = json.dumps(result, ensure_ascii=False, indent=2) + "\n"
     return text
 
 
 def process_text(text, filename='-',
                  start=None, stages=None, profile=False, trace=False,
-                 preprocessor=None):
+                 preprocessor=None, budget=None, output_format="html"):
     headings = None
     profile_data = OrderedDict()
     # If all stages are run, start only applies to the parser state.
-    if stages is None:
+    if stages is None and output_format == "links":
+        result = run_links(text, filename=filename, profile_data=profile_data,
+                           preprocessor=preprocessor, budget=budget)
+        stages = "links"
+    elif stages is None:
         result, headings = run_preprocessor(text, filename=filename,
                                             profile_data=profile_data,
-                                            preprocessor=preprocessor)
+                                            preprocessor=preprocessor,
+                                            budget=budget)
     elif stages == "preprocessor":
         result, headings = run_preprocessor(text, filename=filename, start=start,
                                             profile_data=profile_data,
-                                            preprocessor=preprocessor)
+                                            preprocessor=preprocessor,
+                                            budget=budget)
     elif stages == "plain":
         result = run_plain(text, filename=filename, start=start,
                            profile_data=profile_data,
@@ -85,7 +118,8 @@ def process_text(text, filename='-',
 
     if stages is None or stages == "parser":
         result = run_parser(result, filename=filename, start=start,
-                            profile_data=profile_data, trace=trace, headings=headings)
+                            profile_data=profile_data, trace=trace, headings=headings,
+                            budget=budget, output_format=output_format)
 
     if profile:
         for data in profile_data.values():
@@ -94,37 +128,15 @@ def process_text(text, filename='-',
     return result
 
 
-class DirectoryPreprocessor(mw.Preprocessor):
-    def __init__(self, template_dir=None, **kwargs):
-        self._template_dir = template_dir
-        super(DirectoryPreprocessor, self).__init__(**kwargs)
-
-    def get_template(self, namespace, pagename):
-        if namespace.prefix != "template":
-            return None
-        if self._template_dir is None:
-            return None
-        tmpl_filename = os.path.join(self._template_dir, pagename)
-        if not os.path.exists(tmpl_filename):
-            tmpl_filename = os.path.join(self._template_dir, pagename.lower())
-        if os.path.exists(tmpl_filename):
-            with open(tmpl_filename, "rb") as fh:
-                return fh.read().decode("UTF-8")
-        return super(DirectoryPreprocessor, self).get_template(namespace, pagename)
-
-
-def process(input=None, output=None, *args, **kwargs):
+def read_input(input=None):
+    """Return the file name and the text of INPUT (or stdin)."""
     if input is None:
-        filename = "-"
-        input = sys.stdin.read()
-    else:
-        filename = input
-        with open(input, "rb") as fh:
-            input = fh.read().decode("UTF-8")
+        return "-", sys.stdin.read()
+    with open(input, "rb") as fh:
+        return input, fh.read().decode("UTF-8")
 
-    kwargs["preprocessor"] = partial(DirectoryPreprocessor, kwargs.pop("template_dir", None))
-    result = process_text(input, filename, *args, **kwargs)
 
+def write_output(result, output=None):
     if sys.version < '3':
         result = result.encode("UTF-8")
     if output is None:
@@ -134,6 +146,248 @@ def process(input=None, output=None, *args, **kwargs):
             fh.write(result)
 
 
+def make_preprocessor(template_dir=None, watch=False, tree_cache=None,
+                      cache_size=1024):
+    """Return a preprocessor for the templates in TEMPLATE_DIR, which
+    may also be a template bundle (see mw --build-bundle).  Parsed
+    trees are stored in the directory TREE_CACHE if given.  The
+    process keeps up to CACHE_SIZE templates and trees in memory."""
+    settings = mw.Settings()
+    if tree_cache is not None:
+        settings.tree_cache = mw.TreeCache(tree_cache, cache_size=cache_size)
+    if template_dir is not None and os.path.isfile(template_dir):
+        return mw.BundlePreprocessor(template_dir, cache_size=cache_size,
+                                     watch=watch, settings=settings)
+    return mw.DirectoryPreprocessor(template_dir, cache_size=cache_size,
+                                    watch=watch, settings=settings)
+
+
+def process(input=None, output=None, *args, **kwargs):
+    filename, input = read_input(input)
+
+    kwargs["preprocessor"] = partial(make_preprocessor, kwargs.pop("template_dir", None),
+                                     tree_cache=kwargs.pop("tree_cache", None),
+                                     cache_size=kwargs.pop("cache_size", 1024))
+    timeout = kwargs.pop("timeout", None)
+    max_steps = kwargs.pop("max_steps", None)
+    if timeout is not None or max_steps is not None:
+        kwargs["budget"] = mw.Budget(timeout=timeout, max_steps=max_steps)
+    kwargs["output_format"] = kwargs.pop("format", "html")
+    result = process_text(input, filename, *args, **kwargs)
+    write_output(result, output)
+
+
+# Output file extensions in batch mode, by format.
+OUTPUT_EXTENSIONS = {
+    "html": ".html",
+    "json": ".json",
+    "text": ".txt",
+    "index": ".json",
+    "links": ".json",
+}
+
+
+def collect_inputs(inputs):
+    """Return (path, relative path) for the files in INPUTS, where
+    directories are searched recursively (skipping hidden files)."""
+    files = []
+    for input in inputs:
+        if not os.path.isdir(input):
+            files.append((input, os.path.basename(input)))
+            continue
+        for dirpath, dirnames, filenames in os.walk(input):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+            for filename in sorted(filenames):
+                if filename.startswith("."):
+                    continue
+                path = os.path.join(dirpath, filename)
+                files.append((path, os.path.relpath(path, input)))
+    return files
+
+
+# State of a batch worker process, see init_worker().
+_worker = {}
+
+
+def init_worker(template_dir=None, tree_cache=None, cache_size=1024):
+    """Set up the preprocessor for render_file() in this process.  It
+    keeps its template cache for all files of the worker."""
+    _worker["preprocessor"] = make_preprocessor(template_dir, tree_cache=tree_cache,
+                                                cache_size=cache_size)
+
+
+def render_file(job):
+    """Render one file of a batch, and return the input file name,
+    the time taken and the error message (or None)."""
+    input, output, options = job
+    options = dict(options)
+    timeout = options.pop("timeout", None)
+    max_steps = options.pop("max_steps", None)
+    preprocessor = _worker["preprocessor"]
+    start = default_timer()
+    error = None
+    try:
+        budget = None
+        if timeout is not None or max_steps is not None:
+            budget = mw.Budget(timeout=timeout, max_steps=max_steps)
+        filename, text = read_input(input)
+        result = process_text(text, filename, preprocessor=lambda: preprocessor,
+                              budget=budget, **options)
+        directory = os.path.dirname(output)
+        if directory != "" and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another worker may have created it.
+                if not os.path.isdir(directory):
+                    raise
+        write_output(result, output)
+    except mw.BudgetExceeded as exc:
+        error = "rendering aborted: {0}".format(exc)
+    except Exception as exc:
+        error = "{0}: {1}".format(exc.__class__.__name__, exc)
+    return input, default_timer() - start, error
+
+
+class BatchError(Exception):
+    """The files of a batch can not be rendered."""
+
+
+def batch(inputs, output_dir, jobs=1, template_dir=None, tree_cache=None,
+          cache_size=1024, verbose=False, **options):
+    """Render all files in INPUTS (directories are searched) to
+    OUTPUT_DIR, and return the number of failed files.  BatchError is
+    raised if two input files would be written to the same output
+    file."""
+    output_format = options.get("output_format", "html")
+    if options.get("stages", None) in ("preprocessor", "plain"):
+        extension = ".wiki"
+    else:
+        extension = OUTPUT_EXTENSIONS[output_format]
+    all_jobs = []
+    sources = {}
+    for path, relpath in collect_inputs(inputs):
+        output = os.path.join(output_dir, os.path.splitext(relpath)[0] + extension)
+        if output in sources:
+            raise BatchError("{0} and {1} both write {2}".format(
+                sources[output], path, output))
+        sources[output] = path
+        all_jobs.append((path, output, options))
+
+    start = default_timer()
+    if jobs > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs, init_worker,
+                                    (template_dir, tree_cache, cache_size))
+        chunksize = max(1, min(32, len(all_jobs) // (jobs * 8)))
+        results = pool.imap_unordered(render_file, all_jobs, chunksize)
+    else:
+        pool = None
+        init_worker(template_dir, tree_cache, cache_size)
+        results = (render_file(job) for job in all_jobs)
+
+    timings = []
+    errors = []
+    for input, time, error in results:
+        timings.append((time, input))
+        if error is not None:
+            errors.append(input)
+            print("mw: {0}: {1}".format(input, error), file=sys.stderr)
+        elif verbose:
+            print("{0}: {1:.3f} msecs".format(input, time * 1000), file=sys.stderr)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    elapsed = default_timer() - start
+    print("{files} files, {errors} errors, {elapsed:.2f} secs".format(
+        files=len(timings), errors=len(errors), elapsed=elapsed), file=sys.stderr)
+    if len(timings) > 0:
+        total = sum(time for time, input in timings)
+        print("render time: {total:.2f} secs, {avg:.3f} msecs per file".format(
+            total=total, avg=total * 1000 / len(timings)), file=sys.stderr)
+        for time, input in sorted(timings, reverse=True)[:5]:
+            print("slowest: {0}: {1:.3f} msecs".format(input, time * 1000),
+                  file=sys.stderr)
+    return len(errors)
+
+
+# The process_text options that can be given in a render request.
+REQUEST_OPTIONS = ["start", "stages", "format", "timeout", "max_steps"]
+
+
+def render_request(request, preprocessor=None):
+    """Answer a request of the render server, see smc.mw.server."""
+    try:
+        output_format = request.get("format", "html")
+        if output_format not in BACKENDS:
+            raise ValueError("unknown format " + output_format)
+        budget = None
+        timeout = request.get("timeout", None)
+        max_steps = request.get("max_steps", None)
+        if timeout is not None or max_steps is not None:
+            budget = mw.Budget(timeout=timeout, max_steps=max_steps)
+        output = process_text(request["text"], request.get("filename", "-"),
+                              start=request.get("start", None),
+                              stages=request.get("stages", None),
+                              preprocessor=preprocessor, budget=budget,
+                              output_format=output_format)
+    except mw.BudgetExceeded as exc:
+        return {"error": "rendering aborted: {0}".format(exc), "aborted": True}
+    except Exception as exc:
+        return {"error": "{0}: {1}".format(exc.__class__.__name__, exc)}
+    if not isinstance(output, type("")):
+        output = output.decode("UTF-8")
+    return {"output": output}
+
+
+def serve(socket_path=None, template_dir=None, tree_cache=None, cache_size=1024):
+    """Render requests on a Unix socket, or framed on stdin and
+    stdout, with one preprocessor that keeps its template cache."""
+    from smc.mw import server
+
+    preprocessor = make_preprocessor(template_dir, watch=True, tree_cache=tree_cache,
+                                     cache_size=cache_size)
+    handler = partial(render_request, preprocessor=lambda: preprocessor)
+    if socket_path is None:
+        if sys.version < '3':
+            stdin, stdout = sys.stdin, sys.stdout
+        else:
+            stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+        server.serve_stream(handler, stdin, stdout)
+        return
+    render_server = server.RenderServer(socket_path, handler)
+    # Remove the socket when terminated.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        render_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        render_server.server_close()
+
+
+def connect(socket_path, input=None, output=None, **kwargs):
+    """Render INPUT with the server at SOCKET_PATH."""
+    from smc.mw import server
+
+    filename, text = read_input(input)
+    request = {"text": text, "filename": filename}
+    for option in REQUEST_OPTIONS:
+        if kwargs.get(option, None) is not None:
+            request[option] = kwargs[option]
+    client = server.Client(socket_path)
+    try:
+        response = client.request(request)
+    finally:
+        client.close()
+    if "error" in response:
+        print("mw: {0}".format(response["error"]), file=sys.stderr)
+        sys.exit(1)
+    write_output(response["output"], output)
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Process a MediaWiki formatted text.")
     stages_group = parser.add_mutually_exclusive_group()
@@ -148,26 +402,118 @@ def parse_args():
                               help="only run the parser (not the preprocessor)")
 
     parser.add_argument("-T", metavar="DIRECTORY", dest="template_dir",
-                        help="read templates from directory")
+                        help="read templates from directory, or from a "
+                        "template bundle")
+    parser.add_argument("--tree-cache", metavar="DIRECTORY", dest="tree_cache",
+                        help="keep the parsed preprocessor trees of pages "
+                        "and templates in DIRECTORY")
+    parser.add_argument("--template-cache", metavar="N", type=int, dest="cache_size",
+                        default=1024,
+                        help="keep up to N templates and trees in the memory "
+                        "of each process (default 1024)")
+    parser.add_argument("--build-bundle", metavar="BUNDLE", dest="build_bundle",
+                        help="write the templates of the -T directory to "
+                        "the template bundle BUNDLE and exit")
 
     parser.add_argument("-s", metavar="RULE", dest="start",
                         help="start parsing at the given rule")
     parser.add_argument("-x", action="store_true", dest="profile", default=False,
                         help="print profile information on stderr")
 
+    parser.add_argument("--timeout", metavar="SECONDS", type=float,
+                        help="abort rendering after SECONDS")
+    parser.add_argument("--max-steps", metavar="N", type=int, dest="max_steps",
+                        help="abort rendering after N grammar rule invocations")
+
+    parser.add_argument("-f", metavar="FORMAT", dest="format", default="html",
+                        choices=list(BACKENDS.keys()),
+                        help="output format: html (default), json, text, or "
+                        "index (text, sections, links, categories and "
+                        "references as JSON), or links (outgoing links, "
+                        "categories and templates as JSON, without parsing)")
+
+    server_group = parser.add_mutually_exclusive_group()
+    server_group.add_argument("--serve", action="store_true", default=False,
+                              help="answer render requests on stdin and stdout, "
+                              "or on the socket given by --socket")
+    server_group.add_argument("--connect", metavar="SOCKET", dest="connect",
+                              help="render with the server listening on SOCKET")
+    parser.add_argument("--socket", metavar="SOCKET", dest="socket",
+                        help="Unix socket for --serve")
+
     parser.add_argument("-o", metavar="OUTFILE", dest="output",
-                        help="write output to OUTFILE instead of stdout")
+                        help="write output to OUTFILE instead of stdout "
+                        "(a directory for several input files)")
+    parser.add_argument("-j", metavar="N", type=int, dest="jobs", default=1,
+                        help="render several input files in N processes")
+    parser.add_argument("-v", action="store_true", dest="verbose", default=False,
+                        help="print the render time of every input file")
     parser.add_argument("-t", action="store_true", dest="trace", default=False,
                         help="start parsing at the given rule")
 
-    parser.add_argument("input", metavar="INFILE", nargs="?",
-                        help="input file to process instead of stdin")
-    return parser.parse_args()
+    parser.add_argument("input", metavar="INFILE", nargs="*",
+                        help="input files or directories to process instead "
+                        "of stdin")
+    args = parser.parse_args()
+    args.batch = len(args.input) > 1 or any(os.path.isdir(input)
+                                            for input in args.input)
+    if args.batch and args.output is None:
+        parser.error("-o OUTDIR is required for several input files")
+    if args.batch and (args.serve or args.connect is not None):
+        parser.error("--serve and --connect take a single input file")
+    if args.build_bundle is not None and (args.template_dir is None
+                                          or not os.path.isdir(args.template_dir)):
+        parser.error("--build-bundle requires a -T directory")
+    return args
 
 
 def main():
     args = parse_args()
-    process(**vars(args))
+    kwargs = vars(args)
+    socket_path = kwargs.pop("socket")
+    connect_path = kwargs.pop("connect")
+    jobs = kwargs.pop("jobs")
+    verbose = kwargs.pop("verbose")
+    inputs = kwargs.pop("input")
+    bundle_path = kwargs.pop("build_bundle")
+    if bundle_path is not None:
+        count = mw.build_bundle(bundle_path, args.template_dir)
+        print("mw: {0} templates written to {1}".format(count, bundle_path),
+              file=sys.stderr)
+        return
+    if kwargs.pop("batch"):
+        kwargs["output_format"] = kwargs.pop("format")
+        kwargs.pop("serve")
+        output_dir = kwargs.pop("output")
+        try:
+            errors = batch(inputs, output_dir, jobs=jobs, verbose=verbose, **kwargs)
+        except BatchError as exc:
+            print("mw: {0}".format(exc), file=sys.stderr)
+            sys.exit(1)
+        if errors > 0:
+            sys.exit(1)
+        return
+    kwargs["input"] = inputs[0] if len(inputs) > 0 else None
+    if kwargs.pop("serve"):
+        from smc.mw.server import ServerError
+        try:
+            serve(socket_path, template_dir=args.template_dir,
+                  tree_cache=args.tree_cache, cache_size=args.cache_size)
+        except ServerError as exc:
+            print("mw: {0}".format(exc), file=sys.stderr)
+            sys.exit(1)
+        return
+    if connect_path is not None:
+        connect(connect_path, **kwargs)
+        return
+    try:
+        process(**kwargs)
+    except mw.BudgetExceeded as exc:
+        print("mw: rendering aborted: {0}".format(exc), file=sys.stderr)
+        sys.exit(1)
+    except mw.BundleError as exc:
+        print("mw: {0}".format(exc), file=sys.stderr)
+        sys.exit(1)
 
 
 if __name__ == "__main__":
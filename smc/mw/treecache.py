@@ -0,0 +1,72 @@
+# Copyright 2013 semantics GmbH
+# Written by Marcus Brinkmann <m.brinkmann@semantics.de>
+
+from __future__ import print_function, division
+from __future__ import absolute_import, unicode_literals
+
+import os
+import tempfile
+
+from lxml import etree
+
+from . preprocessor import TREE_VERSION, tree_to_bytes, tree_from_bytes
+from . cache import LRUCache
+
+
+class TreeCache(object):
+    """Preprocessor trees kept in files below DIRECTORY, for
+    Settings.tree_cache, so that new processes need not parse
+    unchanged pages and templates again.  Several processes can share
+    the directory.
+
+    The keys are content hashes (see tree_key), and the trees are
+    stored in a subdirectory for the TREE_VERSION, so trees of
+    another grammar are never used.  Old versions can be removed by
+    deleting their subdirectory.  The most recently used trees are
+    also kept in memory, up to CACHE_SIZE."""
+
+    def __init__(self, directory, cache_size=1024):
+        self.directory = os.path.join(directory, TREE_VERSION)
+        self._trees = LRUCache(cache_size)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:])
+
+    def get(self, key, default=None):
+        tree = self._trees.get(key)
+        if tree is not None:
+            return tree
+        try:
+            with open(self._path(key), "rb") as fh:
+                data = fh.read()
+            tree = tree_from_bytes(data)
+        except (IOError, etree.XMLSyntaxError):
+            return default
+        self._trees[key] = tree
+        return tree
+
+    def __setitem__(self, key, tree):
+        self._trees[key] = tree
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        # Failing to store a tree only means it is parsed again.
+        try:
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # Another process may have created it.
+                    if not os.path.isdir(directory):
+                        raise
+            # Written under a temporary name, so that other processes
+            # never read a partial file.
+            fd, tmp_path = tempfile.mkstemp(dir=directory)
+            try:
+                with os.fdopen(fd, "wb") as fh:
+                    fh.write(tree_to_bytes(tree))
+                os.rename(tmp_path, path)
+            except:
+                os.unlink(tmp_path)
+                raise
+        except (IOError, OSError):
+            pass
@@ -0,0 +1,585 @@
+# Copyright 2013 semantics GmbH
+# Written by Marcus Brinkmann <m.brinkmann@semantics.de>
+
+"""Tests of the Python API that the parser test data can not cover."""
+
+from __future__ import print_function, division
+from __future__ import absolute_import, unicode_literals
+
+import os
+import io
+import sys
+import json
+import time
+import socket
+import shutil
+import tempfile
+import threading
+import subprocess
+import unittest
+
+from lxml import etree
+
+from smc import mw
+from smc.mw import server, tool, templates, bundle
+from smc.mw.preprocessor import tree_to_bytes
+
+import testspec_impl as testspec
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA = os.path.join(ROOT, "tests", "data")
+
+
+def run_python(statements):
+    """Run STATEMENTS in a new interpreter, and return its output."""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = ROOT
+    return subprocess.check_output([sys.executable, "-c", statements],
+                                   env=env, stderr=subprocess.STDOUT).decode("UTF-8")
+
+
+class LazyImportTests(unittest.TestCase):
+    def test_function_and_submodule_names(self):
+        # Importing the submodules mediawiki and links (which happens
+        # on the first access to Parser and Links) must not hide the
+        # functions of the same name.
+        output = run_python("import smc.mw as mw\n"
+                            "mw.Parser\n"
+                            "mw.Links\n"
+                            "print(repr(mw.mediawiki('x')))\n"
+                            "print(mw.links('[[A]]')['links'])\n")
+        lines = output.splitlines()
+        self.assertIn("<p>x", lines[0])
+        self.assertIn("A", lines[1])
+
+    def test_import_submodule(self):
+        output = run_python("import smc.mw as mw\n"
+                            "import smc.mw.plaintext\n"
+                            "print(callable(mw.plaintext))\n")
+        self.assertEqual(output.strip(), "True")
+
+    def test_star_import(self):
+        output = run_python("from __future__ import print_function\n"
+                            "from smc.mw import *\n"
+                            "print(callable(mediawiki), Parser is not None)\n"
+                            "print(sorted(name for name in ('sys', 'importlib', 'ModuleType')\n"
+                            "             if name in globals()))\n")
+        self.assertEqual(output.splitlines(), ["True True", "[]"])
+
+
+# A page with some of everything.
+PAGE = "== H ==\nSome ''text'' [[A|b]].\n\n* item\n"
+
+
+class BudgetTests(unittest.TestCase):
+    def test_steps(self):
+        self.assertRaises(mw.BudgetExceeded, mw.mediawiki, PAGE,
+                          budget=mw.Budget(max_steps=10))
+
+    def test_deadline(self):
+        self.assertRaises(mw.BudgetExceeded, mw.mediawiki, PAGE,
+                          budget=mw.Budget(timeout=0, check_interval=1))
+
+    def test_sufficient(self):
+        self.assertEqual(mw.mediawiki(PAGE, budget=mw.Budget(timeout=60, max_steps=10 ** 7)),
+                         mw.mediawiki(PAGE))
+
+    def test_degraded(self):
+        output = mw.mediawiki(PAGE, budget=mw.Budget(max_steps=10), degraded=True)
+        if not isinstance(output, str):
+            output = output.decode("UTF-8")
+        self.assertIn("<p>== H ==\nSome ''text'' [[A|b]].\n</p>", output)
+        self.assertIn("<p>* item\n</p>", output)
+
+    def test_nesting(self):
+        # The budget must not cost recursion depth.
+        text = "a [[" * 40 + "b\n"
+        self.assertEqual(mw.mediawiki(text, budget=mw.Budget(timeout=120), degraded=True),
+                         mw.mediawiki(text))
+
+    def test_recursion_limit(self):
+        text = "a [[" * 400 + "b\n"
+        self.assertRaises(mw.BudgetExceeded, mw.mediawiki, text)
+        output = mw.mediawiki(text, degraded=True)
+        if not isinstance(output, str):
+            output = output.decode("UTF-8")
+        self.assertIn("<p>a [[a [[", output)
+
+
+class BackendTests(unittest.TestCase):
+    def test_tree(self):
+        tree = mw.MediaWiki(PAGE, backend=mw.TreeBackend()).render()
+        self.assertEqual(tree.tag, "html")
+        self.assertEqual([el.tag for el in tree[0]], ["h2", "p", "ul"])
+
+    def test_html(self):
+        output = mw.MediaWiki(PAGE, backend=mw.HTMLBackend()).render()
+        # A native string, while mediawiki() returns bytes.
+        self.assertTrue(isinstance(output, str))
+        expected = mw.mediawiki(PAGE)
+        if sys.version >= "3":
+            expected = expected.decode("UTF-8")
+        self.assertEqual(output, expected)
+
+    def test_text(self):
+        output = mw.MediaWiki(PAGE, backend=mw.TextBackend()).render()
+        self.assertEqual(output, "H\n\nSome text b.\n\n* item\n")
+
+    def test_json(self):
+        output = mw.MediaWiki(PAGE, backend=mw.JSONBackend()).render()
+        body = json.loads(output)[1]
+        self.assertEqual(body[0], "body")
+        self.assertEqual(body[3], ["p", "Some ", ["i", "text"], " ",
+                                   ["a", {"href": "/wiki/A", "title": "A"}, "b"],
+                                   ".\n"])
+
+
+class PlainTextTests(unittest.TestCase):
+    def test_fields(self):
+        page = mw.PlainText("== H ==\n"
+                            "See [[Image:F.jpg|a [[B]] c]] and [[A|b]]."
+                            "<ref name=\"n\">One</ref><ref name=\"n\"/><ref>Two</ref>\n\n"
+                            "=== Sub ===\n[[Category:C]] text\n\n<references/>")
+        self.assertEqual(page.text, "H\n\nSee a B c and b.\n\nSub\n\ntext\n")
+        self.assertEqual(page.sections, [{"level": 2, "title": "H"},
+                                         {"level": 3, "title": "Sub"}])
+        # In input order, so the image comes before the link in its
+        # caption.
+        self.assertEqual(page.links, ["Image:F.jpg", "B", "A"])
+        self.assertEqual(page.categories, ["C"])
+        self.assertEqual(page.references, ["One", "Two"])
+
+    def test_plaintext(self):
+        self.assertEqual(mw.plaintext(PAGE), "H\n\nSome text b.\n\n* item\n")
+
+
+class RecordingSettings(mw.Settings):
+    """Records the page existence lookups.  Page "Missing" does not
+    exist."""
+
+    def __init__(self, *args, **kwargs):
+        super(RecordingSettings, self).__init__(*args, **kwargs)
+        self.lookups = []
+        self.batches = []
+
+    def test_page_exists(self, name):
+        self.lookups.append(name[1])
+        return name[1] != "Missing"
+
+    def test_pages_exist(self, names):
+        self.batches.append([name[1] for name in names])
+        return super(RecordingSettings, self).test_pages_exist(names)
+
+
+def render(text, settings):
+    parser = mw.Parser(parseinfo=False)
+    semantics = mw.Semantics(parser, settings=settings)
+    ast = parser.parse(text, "document", semantics=semantics, trace=False,
+                       nameguard=False, whitespace="")
+    return etree.tostring(ast)
+
+
+LINKS = "[[A]] [[Missing]] [[a]] [[A|again]]"
+
+
+class LinkCacheTests(unittest.TestCase):
+    def test_once_per_page(self):
+        settings = RecordingSettings()
+        output = render(LINKS, settings)
+        # Once per target, [[a]] is another one.
+        self.assertEqual(settings.lookups, ["A", "Missing", "A"])
+        self.assertIn('class="new"', output.decode("UTF-8"))
+
+    def test_across_renders(self):
+        settings = RecordingSettings()
+        settings.link_cache = mw.LRUCache(10)
+        output = render(LINKS, settings)
+        self.assertEqual(render(LINKS, settings), output)
+        self.assertEqual(settings.lookups, ["A", "Missing", "A"])
+
+
+class BatchPageExistsTests(unittest.TestCase):
+    def test_batch(self):
+        settings = RecordingSettings()
+        settings.batch_page_exists = True
+        output = render(LINKS, settings)
+        self.assertEqual(settings.batches, [["A", "Missing"]])
+        self.assertEqual(output, render(LINKS, RecordingSettings()))
+
+
+class BatchTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.input_dir = os.path.join(self.directory, "in")
+        self.output_dir = os.path.join(self.directory, "out")
+        self.template_dir = os.path.join(self.directory, "templates")
+        os.makedirs(os.path.join(self.input_dir, "sub"))
+        os.makedirs(self.template_dir)
+        files = [(os.path.join(self.input_dir, "a.wiki"), "''a''"),
+                 (os.path.join(self.input_dir, "sub", "b.wiki"), "{{Greeting}}"),
+                 (os.path.join(self.input_dir, ".hidden"), "hidden"),
+                 (os.path.join(self.template_dir, "Greeting"), "Hello")]
+        for path, text in files:
+            with open(path, "wb") as fh:
+                fh.write(text.encode("UTF-8"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def mw(self, *args):
+        env = dict(os.environ)
+        env["PYTHONPATH"] = ROOT
+        proc = subprocess.Popen([sys.executable, "-m", "smc.mw.tool"] + list(args),
+                                env=env, stderr=subprocess.PIPE)
+        stderr = proc.communicate()[1].decode("UTF-8")
+        return proc.returncode, stderr
+
+    def read_output(self, *path):
+        with open(os.path.join(self.output_dir, *path), "rb") as fh:
+            return fh.read().decode("UTF-8")
+
+    def test_directory(self):
+        status, stderr = self.mw("-j", "2", "-f", "text", "-T", self.template_dir,
+                                 "-o", self.output_dir, self.input_dir)
+        self.assertEqual(status, 0)
+        self.assertIn("2 files, 0 errors", stderr)
+        self.assertEqual(self.read_output("a.txt"), "a\n")
+        self.assertEqual(self.read_output("sub", "b.txt"), "Hello\n")
+
+    def test_errors(self):
+        status, stderr = self.mw("--max-steps", "1", "-o", self.output_dir,
+                                 os.path.join(self.input_dir, "a.wiki"),
+                                 os.path.join(self.input_dir, "sub"))
+        self.assertEqual(status, 1)
+        self.assertIn("2 files, 2 errors", stderr)
+        self.assertIn("rendering aborted", stderr)
+
+    def test_collision(self):
+        write_file(os.path.join(self.input_dir, "sub", "a.txt"), "a")
+        status, stderr = self.mw("-o", self.output_dir, self.input_dir,
+                                 os.path.join(self.input_dir, "sub"))
+        self.assertEqual(status, 1)
+        self.assertIn("both write", stderr)
+        self.assertFalse(os.path.exists(self.output_dir))
+
+
+class ArticlePreprocessor(mw.Preprocessor):
+    """Templates from the articles of the parser test data."""
+
+    def __init__(self, *args, **kwargs):
+        super(ArticlePreprocessor, self).__init__(*args, **kwargs)
+        self.articles = {}
+
+    def get_template(self, namespace, pagename):
+        return self.articles.get((namespace.prefix, pagename), None)
+
+
+def iter_cases(preprocessor):
+    """Yield all test cases of the parser test data, with the articles
+    that precede them registered in PREPROCESSOR."""
+    settings = preprocessor.settings
+    for filename in sorted(os.listdir(DATA)):
+        if not filename.endswith(".txt"):
+            continue
+        with open(os.path.join(DATA, filename), "r") as fh:
+            cases = testspec.load(fh)
+        for case in cases:
+            if case["type"] == "article":
+                ns, pn = settings.canonical_page_name(case["title"])
+                preprocessor.articles[(ns.prefix, pn)] = case["text"]
+            else:
+                yield case
+
+
+class LinksTests(unittest.TestCase):
+    # Where the parser misses links that MediaWiki (and the scan) finds.
+    KNOWN_DIFFERENCES = frozenset([
+        # Link targets with '' are taken as formatting.
+        "Link containing double-single-quotes '' (bug 4598)",
+        "Link with double quotes in title part (literal) and alternate part (interpreted)",
+        # Headings are plain text.
+        "Link inside a section heading",
+        "Bug 33845: Headings become cursive in TOC when they contain an image",
+        "nowiki inside link inside heading (bug 18295)",
+        # Links in the names of missing templates and functions.
+        "Template with targets containing wikilinks",
+        "anchorencode deals with links",
+        ])
+
+    def test_same_as_parser(self):
+        # The scan must find the links the parser finds.
+        preprocessor = ArticlePreprocessor()
+        differences = []
+        for case in iter_cases(preprocessor):
+            text = case["input"]
+            try:
+                page = mw.PlainText(text, preprocessor=preprocessor)
+            except Exception:
+                # Parser errors are covered by mwtests.
+                continue
+            scan = mw.Links(text, preprocessor=preprocessor)
+            if (scan.links, scan.categories) != (page.links, page.categories):
+                differences.append(case["description"])
+        unexpected = [description for description in differences
+                      if description not in self.KNOWN_DIFFERENCES]
+        self.assertEqual(unexpected, [])
+
+
+class ServerTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "mw.sock")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_stale_socket(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        sock.close()
+        render_server = server.RenderServer(self.path, lambda request: request)
+        render_server.server_close()
+
+    def test_socket_in_use(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        sock.listen(1)
+        try:
+            self.assertRaises(server.ServerError, server.RenderServer,
+                              self.path, lambda request: request)
+        finally:
+            sock.close()
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_not_a_socket(self):
+        with open(self.path, "w") as fh:
+            fh.write("data")
+        self.assertRaises(server.ServerError, server.RenderServer,
+                          self.path, lambda request: request)
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_serve_stream(self):
+        requests = io.BytesIO()
+        server.write_message(requests, {"text": "''x''"})
+        server.write_message(requests, {"text": "''x''", "max_steps": 1})
+        server.write_message(requests, {"text": "''x''", "format": "text"})
+        requests.seek(0)
+        responses = io.BytesIO()
+        server.serve_stream(tool.render_request, requests, responses)
+        responses.seek(0)
+        self.assertIn("<i>x</i>", server.read_message(responses)["output"])
+        self.assertEqual(server.read_message(responses)["aborted"], True)
+        self.assertEqual(server.read_message(responses)["output"], "x\n")
+        self.assertEqual(server.read_message(responses), None)
+
+    def test_client(self):
+        env = dict(os.environ)
+        env["PYTHONPATH"] = ROOT
+        proc = subprocess.Popen([sys.executable, "-m", "smc.mw.tool",
+                                 "--serve", "--socket", self.path], env=env)
+        try:
+            for i in range(100):
+                if os.path.exists(self.path):
+                    break
+                time.sleep(0.1)
+            client = server.Client(self.path)
+            try:
+                response = client.request({"text": "[[A]]", "format": "text"})
+                self.assertEqual(response["output"], "A\n")
+                response = client.request({"text": "x", "format": "nonsense"})
+                self.assertIn("unknown format", response["error"])
+            finally:
+                client.close()
+        finally:
+            proc.terminate()
+            proc.wait()
+        # The server removes its socket when terminated.
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_idle_client(self):
+        render_server = server.RenderServer(self.path, lambda request: request,
+                                            timeout=0.2)
+        thread = threading.Thread(target=render_server.serve_forever)
+        thread.start()
+        try:
+            idle = server.Client(self.path)
+            client = server.Client(self.path)
+            try:
+                self.assertEqual(client.request({"text": "x"}), {"text": "x"})
+            finally:
+                client.close()
+                idle.close()
+        finally:
+            render_server.shutdown()
+            thread.join()
+            render_server.server_close()
+
+    def test_message_too_large(self):
+        fh = io.BytesIO(server.HEADER.pack(server.MAX_MESSAGE_SIZE + 1))
+        self.assertRaises(server.ProtocolError, server.read_message, fh)
+
+
+class CSSFilterTests(unittest.TestCase):
+    def test_threads(self):
+        from smc.mw.html import css_filter
+        styles = ["width: {0}px".format(i) for i in range(3000)]
+        errors = []
+
+        def run():
+            try:
+                for style in styles:
+                    if css_filter(style) != style:
+                        errors.append(style)
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=run) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+
+class TreeCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_roundtrip(self):
+        preprocessor = mw.Preprocessor()
+        tree = preprocessor.parse("a {{b|c}} d")
+        cache = mw.TreeCache(self.directory)
+        cache["0123"] = tree
+        cache = mw.TreeCache(self.directory)
+        self.assertEqual(tree_to_bytes(cache.get("0123")),
+                         tree_to_bytes(tree))
+
+    def test_failed_write(self):
+        cache = mw.TreeCache(self.directory)
+        # A directory in the way makes the rename fail.
+        path = cache._path("0123")
+        os.makedirs(os.path.join(path, "x"))
+        cache["0123"] = mw.Preprocessor().parse("a")
+        self.assertEqual(os.listdir(os.path.dirname(path)), ["23"])
+        # The tree is still cached in memory.
+        self.assertNotEqual(cache.get("0123"), None)
+
+
+def write_file(path, text, mtime=None):
+    with open(path, "wb") as fh:
+        fh.write(text.encode("UTF-8"))
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+class DirectoryPreprocessorTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.directory, "Greeting"))
+        write_file(os.path.join(self.directory, "Greeting", "Formal"), "Dear {{{1}}}")
+        write_file(os.path.join(self.directory, "Hello"), "Hello", mtime=1000)
+        write_file(os.path.join(self.directory, "lower"), "lower")
+        # Changes in the same second must be noticed.
+        os.utime(self.directory, (1000, 1000))
+        self.watch_interval = templates.WATCH_INTERVAL
+        templates.WATCH_INTERVAL = 0
+
+    def tearDown(self):
+        templates.WATCH_INTERVAL = self.watch_interval
+        shutil.rmtree(self.directory)
+
+    def test_lookup(self):
+        preprocessor = mw.DirectoryPreprocessor(self.directory)
+        self.assertEqual(preprocessor.expand(None, "{{Hello}} {{Greeting/Formal|you}}"),
+                         "Hello Dear you")
+        # Lower case file names are a fallback.
+        self.assertEqual(preprocessor.expand(None, "{{Lower}}"), "lower")
+        self.assertEqual(preprocessor.expand(None, "{{Missing}}"), "[[Template:Missing]]")
+
+    def test_watch(self):
+        preprocessor = mw.DirectoryPreprocessor(self.directory, watch=True)
+        self.assertEqual(preprocessor.expand(None, "{{Hello}} {{New}}"),
+                         "Hello [[Template:New]]")
+        write_file(os.path.join(self.directory, "Hello"), "Hi", mtime=2000)
+        write_file(os.path.join(self.directory, "New"), "new")
+        self.assertEqual(preprocessor.expand(None, "{{Hello}} {{New}}"), "Hi new")
+
+    def test_no_watch(self):
+        # Without watch, the directory is scanned and each template is
+        # read only once.
+        preprocessor = mw.DirectoryPreprocessor(self.directory)
+        self.assertEqual(preprocessor.expand(None, "{{Hello}} {{New}}"),
+                         "Hello [[Template:New]]")
+        write_file(os.path.join(self.directory, "Hello"), "Hi", mtime=2000)
+        write_file(os.path.join(self.directory, "New"), "new")
+        self.assertEqual(preprocessor.expand(None, "{{Hello}} {{New}}"),
+                         "Hello [[Template:New]]")
+
+
+class BundleTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.template_dir = os.path.join(self.directory, "templates")
+        os.makedirs(os.path.join(self.template_dir, "Greeting"))
+        with open(os.path.join(self.template_dir, "Greeting", "Formal"), "wb") as fh:
+            fh.write("Dear {{{1}}}".encode("UTF-8"))
+        with open(os.path.join(self.template_dir, "Hello"), "wb") as fh:
+            fh.write("Hello {{{1|world}}}".encode("UTF-8"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_build(self):
+        path = os.path.join(self.directory, "templates.bundle")
+        self.assertEqual(mw.build_bundle(path, self.template_dir), 2)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o644)
+        text = "{{Hello}}, {{Greeting/Formal|reader}}"
+        directory = mw.DirectoryPreprocessor(self.template_dir)
+        bundle = mw.BundlePreprocessor(path)
+        self.assertEqual(bundle.expand(None, text), "Hello world, Dear reader")
+        self.assertEqual(bundle.expand(None, text), directory.expand(None, text))
+
+    def test_reload(self):
+        path = os.path.join(self.directory, "templates.bundle")
+        mw.build_bundle(path, self.template_dir)
+        preprocessor = mw.BundlePreprocessor(path, watch=True)
+        watch_interval = bundle.WATCH_INTERVAL
+        bundle.WATCH_INTERVAL = 0
+        try:
+            self.assertEqual(preprocessor.expand(None, "{{Hello}}"), "Hello world")
+            write_file(os.path.join(self.template_dir, "Hello"), "Hi {{{1|there}}}")
+            mw.build_bundle(path, self.template_dir)
+            self.assertEqual(preprocessor.expand(None, "{{Hello}}"), "Hi there")
+        finally:
+            bundle.WATCH_INTERVAL = watch_interval
+
+    def test_shared(self):
+        # Several preprocessors can use one mapping, each with its
+        # own caches.
+        path = os.path.join(self.directory, "templates.bundle")
+        mw.build_bundle(path, self.template_dir)
+        template_bundle = mw.TemplateBundle(path)
+        first = mw.BundlePreprocessor(template_bundle)
+        second = mw.BundlePreprocessor(template_bundle, cache_size=1)
+        text = "{{Hello|you}} {{Greeting/Formal|reader}} {{Hello}}"
+        self.assertEqual(first.expand(None, text), "Hello you Dear reader Hello world")
+        self.assertEqual(second.expand(None, text), first.expand(None, text))
+
+    def test_failed_build(self):
+        # A directory in the way makes the rename fail.
+        path = os.path.join(self.directory, "templates.bundle")
+        os.makedirs(os.path.join(path, "x"))
+        self.assertRaises(OSError, mw.build_bundle, path, self.template_dir)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ["templates", "templates.bundle"])
+
+    def test_not_a_bundle(self):
+        self.assertRaises(mw.BundleError, mw.TemplateBundle,
+                          os.path.join(self.template_dir, "Hello"))
+
+
+if __name__ == "__main__":
+    unittest.main()
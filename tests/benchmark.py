@@ -0,0 +1,371 @@
+#!/usr/bin/env python2.7
+# Copyright 2013 semantics GmbH
+# Written by Marcus Brinkmann <m.brinkmann@semantics.de>
+
+"""Repeatable performance numbers for the parserTests cases, a set of
+large articles, some micro benchmarks of hot spots in the semantics
+and the start-up time, with comparison against a baseline file.
+
+Every case is rendered (preprocessor and parser) warmup + repeat
+times, and the median, percentiles and the peak RSS are stored as
+JSON.  With --baseline, cases whose median got slower by more than
+--threshold are reported and the exit status is 1."""
+
+from __future__ import print_function, division
+from __future__ import absolute_import, unicode_literals
+
+import sys
+import io
+import os
+import re
+import json
+import platform
+import argparse
+import resource
+import subprocess
+import datetime
+from collections import OrderedDict
+from timeit import default_timer
+
+from lxml import etree
+
+from smc import mw
+from smc.mw.html import css_filter
+
+import testspec_impl as testspec
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(TEST_DIR, "data")
+ARTICLE_DIR = os.path.join(TEST_DIR, "extra-data", "preprocess")
+# The realistic articles that render in reasonable time.
+ARTICLES = ["Fundraising", "NestedTemplates", "QuoteQuran"]
+# The parsers recurse once per nesting level and rule, which is too
+# deep for the default limit on the articles.
+RECURSION_LIMIT = 30000
+# Paragraph lengths (in characters) for the micro benchmarks.
+MICRO_PARAGRAPH_SIZES = [1000, 10000, 100000]
+# Statements timed in a new interpreter by the startup suite.
+STARTUP_STATEMENTS = [
+    ("python", "pass"),
+    ("import", "import smc.mw"),
+    ("settings", "from smc import mw; mw.Settings()"),
+    ("preprocessor", "from smc import mw; mw.Preprocessor().expand(None, 'x')"),
+    ("render", "from smc import mw; mw.mediawiki('x')"),
+]
+
+
+class BenchSettings(mw.Settings):
+    def __init__(self, *args, **kwargs):
+        super(BenchSettings, self).__init__(*args, **kwargs)
+        self.templates = {}
+
+    def test_page_exists(self, name):
+        return (name[0].prefix, name[1]) in self.templates
+
+
+class BenchPreprocessor(mw.Preprocessor):
+    def get_time(self, utc=False):
+        return datetime.datetime(1970, 1, 1, 0, 2)
+
+    def get_template(self, namespace, pagename):
+        return self.settings.templates.get((namespace.prefix, pagename), None)
+
+
+class Case(object):
+    def __init__(self, name, text, templates=None):
+        self.name = name
+        self.text = text
+        # Snapshot of the articles defined before this case.
+        self.templates = templates
+
+    def run(self, preprocessor):
+        if self.templates is not None:
+            preprocessor.settings.templates = self.templates
+        text, headings = preprocessor._expand("Parser_test", self.text)
+        parser = mw.Parser(parseinfo=False, whitespace='', nameguard=False)
+        semantics = mw.Semantics(parser, headings=headings,
+                                 settings=preprocessor.settings)
+        parser.parse(text, "document", semantics=semantics, trace=False,
+                     nameguard=False, whitespace='')
+
+
+class MicroCase(Case):
+    """A single hot spot of the semantics on synthetic input, without
+    parsing."""
+
+    def __init__(self, name, fn, *args):
+        self.name = name
+        self.fn = fn
+        self.args = args
+
+    def run(self, preprocessor):
+        self.fn(*self.args)
+
+
+def _collect_paragraph(semantics, n):
+    # The inline rules yield mostly single characters, with some
+    # elements (links, formatting) in between.
+    children = []
+    for i in range(n):
+        if i % 100 == 99:
+            children.append(etree.Element("a"))
+        else:
+            children.append("x")
+    semantics._collect_inline(etree.Element("p"), children)
+
+
+def _filter_styles(styles):
+    for style in styles:
+        css_filter(style)
+
+
+def load_micro():
+    semantics = mw.Semantics(None)
+    cases = [MicroCase("micro:collect_inline-%d" % n, _collect_paragraph, semantics, n)
+             for n in MICRO_PARAGRAPH_SIZES]
+    # A table with a few distinct cell styles.
+    styles = ["background:#%02x0000; text-align:center" % (i % 8) for i in range(1000)]
+    cases.append(MicroCase("micro:css_filter", _filter_styles, styles))
+    return cases
+
+
+def _run_python(statement):
+    subprocess.check_call([sys.executable, "-c", statement])
+
+
+def load_startup():
+    """Start-up costs of short-lived processes, each in a fresh
+    interpreter."""
+    return [MicroCase("startup:" + name, _run_python, statement)
+            for name, statement in STARTUP_STATEMENTS]
+
+
+def load_parser_tests(directory, filter=None):
+    cases = []
+    templates = {}
+    settings = mw.Settings()
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(".txt"):
+            continue
+        name, _ = os.path.splitext(filename)
+        with open(os.path.join(directory, filename), "r") as fh:
+            test_data = testspec.load(fh)
+        index = 0
+        for case in test_data:
+            if case["type"] == "article":
+                ns, pn = settings.canonical_page_name(case["title"])
+                templates = dict(templates)
+                templates[(ns.prefix, pn)] = case["text"]
+                continue
+            index = index + 1
+            # Skip the same tests as mwtests.py does, and those that
+            # only run the preprocessor.
+            options = (case.get("options") or "").lower()
+            if re.search(r"\b(disabled|pst|msg|subpage|section|replace)\b", options):
+                continue
+            if filter is not None and filter.match(case["description"]) is None:
+                continue
+            case_name = "{name}:{index:04}".format(name=name, index=index)
+            cases.append(Case(case_name, case["input"], templates))
+    return cases
+
+
+def load_articles(directory, names):
+    cases = []
+    for name in names:
+        with io.open(os.path.join(directory, name + ".txt"), encoding="utf-8") as fh:
+            cases.append(Case("article:" + name, fh.read()))
+    return cases
+
+
+def _maxrss():
+    # Kilobytes on Linux, bytes on Mac OS X.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        rss = rss // 1024
+    return rss
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    if len(samples) == 1:
+        return samples[0]
+    pos = (len(samples) - 1) * pct / 100
+    lower = int(pos)
+    upper = min(lower + 1, len(samples) - 1)
+    return samples[lower] + (samples[upper] - samples[lower]) * (pos - lower)
+
+
+def run_benchmark(cases, warmup=1, repeat=5, verbose=False):
+    preprocessor = BenchPreprocessor(settings=BenchSettings())
+    results = OrderedDict()
+    for case in cases:
+        samples = []
+        try:
+            for _ in range(warmup):
+                case.run(preprocessor)
+            rss_before = _maxrss()
+            for _ in range(repeat):
+                start = default_timer()
+                case.run(preprocessor)
+                samples.append((default_timer() - start) * 1000)
+        except Exception as exc:
+            # Broken cases are reported by mwtests.py, not timed here.
+            results[case.name] = OrderedDict([("error", exc.__class__.__name__)])
+            if verbose:
+                print("{name:32} {error}".format(name=case.name,
+                                                 error=exc.__class__.__name__),
+                      file=sys.stderr)
+            continue
+        result = OrderedDict()
+        result["median"] = percentile(samples, 50)
+        result["p90"] = percentile(samples, 90)
+        result["min"] = min(samples)
+        result["max"] = max(samples)
+        result["rss_delta"] = _maxrss() - rss_before
+        result["samples"] = samples
+        results[case.name] = result
+        if verbose:
+            print("{name:32} {median:10.2f} msecs (p90 {p90:.2f})".format(
+                name=case.name, **result), file=sys.stderr)
+    return results
+
+
+def summarize(results):
+    suites = OrderedDict()
+    for name, result in results.items():
+        if "median" not in result:
+            continue
+        suite = name.split(":")[0]
+        suites[suite] = suites.get(suite, 0) + result["median"]
+    return suites
+
+
+def compare(baseline, current, threshold, min_delta):
+    """Return the regressed and improved (name, old, new) medians.
+
+    Single cases are noisy, so a case only counts if all its samples
+    are beyond the baseline samples as well.  The suite totals are
+    compared by the threshold alone."""
+    regressions = []
+    improvements = []
+
+    def _check(name, old, new, overlap):
+        if abs(new - old) < min_delta:
+            return
+        if new > old * (1 + threshold) and not overlap:
+            regressions.append((name, old, new))
+        elif new < old / (1 + threshold) and not overlap:
+            improvements.append((name, old, new))
+
+    old_results = baseline["results"]
+    for name, result in current["results"].items():
+        old = old_results.get(name, None)
+        if old is None or "median" not in old or "median" not in result:
+            continue
+        overlap = result["min"] <= old["max"] and old["min"] <= result["max"]
+        _check(name, old["median"], result["median"], overlap)
+
+    old_suites = summarize(old_results)
+    for suite, total in summarize(current["results"]).items():
+        if suite in old_suites:
+            _check(suite, old_suites[suite], total, False)
+    return regressions, improvements
+
+
+def print_comparison(baseline, current, regressions, improvements):
+    def _change(old, new):
+        return "{old:10.2f} -> {new:10.2f} msecs ({pct:+.1f}%)".format(
+            old=old, new=new, pct=100 * (new - old) / old if old else 0)
+
+    old_suites = summarize(baseline["results"])
+    for suite, total in summarize(current["results"]).items():
+        if suite in old_suites:
+            print("{suite:32} {change}".format(suite=suite,
+                                               change=_change(old_suites[suite], total)))
+        else:
+            print("{suite:32} not in baseline".format(suite=suite))
+    print("peak RSS: {old} -> {new} KB".format(old=baseline.get("peak_rss"),
+                                              new=current.get("peak_rss")))
+    print("{0} improvements, {1} regressions".format(len(improvements), len(regressions)))
+    regressions = sorted(regressions, key=lambda r: r[1] - r[2])
+    for name, old, new in regressions:
+        print("REGRESSION {name:32} {change}".format(name=name, change=_change(old, new)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the parser and compare against a baseline.")
+    parser.add_argument("--suite", choices=["all", "parser", "articles", "micro", "startup"], default="all",
+                        help="which cases to run")
+    parser.add_argument("-k", metavar="REGEX", dest="filter",
+                        help="only run parserTests whose description matches REGEX")
+    parser.add_argument("--warmup", metavar="N", type=int, default=1,
+                        help="untimed runs per case")
+    parser.add_argument("--repeat", metavar="N", type=int, default=5,
+                        help="timed runs per case")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="results to compare against")
+    parser.add_argument("--threshold", metavar="FRACTION", type=float, default=0.10,
+                        help="relative slowdown of the median counted as regression")
+    parser.add_argument("--min-delta", metavar="MSECS", type=float, default=1.0,
+                        dest="min_delta",
+                        help="ignore changes smaller than MSECS")
+    parser.add_argument("--recursion-limit", metavar="N", type=int,
+                        default=RECURSION_LIMIT, dest="recursion_limit",
+                        help="Python recursion limit while rendering")
+    parser.add_argument("-o", metavar="OUTFILE", dest="output",
+                        help="write results as JSON to OUTFILE")
+    parser.add_argument("-v", action="store_true", dest="verbose", default=False,
+                        help="print every case on stderr")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    filter = None
+    if args.filter is not None:
+        filter = re.compile(args.filter)
+
+    cases = []
+    if args.suite in ("all", "parser"):
+        cases.extend(load_parser_tests(DATA_DIR, filter=filter))
+    if args.suite in ("all", "articles"):
+        cases.extend(load_articles(ARTICLE_DIR, ARTICLES))
+    if args.suite in ("all", "micro"):
+        cases.extend(load_micro())
+    if args.suite in ("all", "startup"):
+        cases.extend(load_startup())
+
+    sys.setrecursionlimit(args.recursion_limit)
+    results = run_benchmark(cases, warmup=args.warmup, repeat=args.repeat,
+                            verbose=args.verbose)
+    current = OrderedDict()
+    current["meta"] = OrderedDict([
+        ("date", datetime.datetime.now().isoformat()),
+        ("python", platform.python_version()),
+        ("platform", platform.platform()),
+        ("warmup", args.warmup),
+        ("repeat", args.repeat),
+        ("recursion_limit", args.recursion_limit)])
+    current["peak_rss"] = _maxrss()
+    current["results"] = results
+
+    for suite, total in summarize(results).items():
+        print("{suite:32} {total:10.2f} msecs".format(suite=suite, total=total))
+
+    if args.output is not None:
+        with open(args.output, "w") as fh:
+            json.dump(current, fh, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as fh:
+            baseline = json.load(fh)
+        regressions, improvements = compare(baseline, current, args.threshold,
+                                            args.min_delta)
+        print_comparison(baseline, current, regressions, improvements)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
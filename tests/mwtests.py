@@ -139,8 +139,9 @@ def tidy_equal(output, expect):
 class Test(object):
     # index: running count in the input file
     # description: one-line (or more) description of the test
-    # options:
-    # config:
+    # options: "preprocess" compares the output of the preprocessor
+    # config: name=value lines that set Settings attributes (values
+    #   are JSON), others (MediaWiki globals) are ignored
     # input: input wiki text
     # result: expected result
     #
@@ -156,6 +157,7 @@ class Test(object):
             self._preprocessor = preprocessor
 
         self.options = None
+        self.config = None
         for key, value in data.items():
             setattr(self, key, value)
 
@@ -176,7 +178,8 @@ class Test(object):
                     val = val[0]
             self.options[key] = val
         if "stages" not in data:
-            if "section" in self.options or "replace" in self.options:
+            if ("section" in self.options or "replace" in self.options
+                    or "preprocess" in self.options):
                 self.stages = ["preprocessor"]
             else:
                 self.stages = ["preprocessor", "parser"]
@@ -218,7 +221,11 @@ class Test(object):
                 out = ""
             return out
 
-        return self._preprocessor._expand("Parser_test", inp)
+        out = self._preprocessor._expand("Parser_test", inp)
+        if "preprocess" in self.options:
+            # Without the headings, which are only for the parser.
+            out = out[0]
+        return out
 
     @profiled
     def parser(self, inp, profile_data=None):
@@ -241,11 +248,35 @@ class Test(object):
             text = text + etree.tostring(node).decode("utf-8")
         return text
 
+    def _settings_config(self):
+        settings = self._preprocessor.settings
+        config = {}
+        for line in (self.config or "").splitlines():
+            name, sep, value = line.partition("=")
+            name = name.strip()
+            if sep == "" or not hasattr(settings, name):
+                continue
+            try:
+                config[name] = json.loads(value)
+            except ValueError:
+                config[name] = value.strip()
+        return config
+
     def run(self):
-        output = self.input
-        for stage in self.stages:
-            cmd = getattr(self, stage)
-            output = cmd(output, profile_data=self.profile)
+        # The settings are shared by all tests, so restore them after.
+        settings = self._preprocessor.settings
+        config = self._settings_config()
+        saved = dict((name, getattr(settings, name)) for name in config)
+        for name, value in config.items():
+            setattr(settings, name, value)
+        try:
+            output = self.input
+            for stage in self.stages:
+                cmd = getattr(self, stage)
+                output = cmd(output, profile_data=self.profile)
+        finally:
+            for name, value in saved.items():
+                setattr(settings, name, value)
 
         self.output = output
         if output == self.result:
@@ -265,61 +296,131 @@ class Test(object):
         return data
 
 
-def main(default_dir, output_file, filter=None):
+# State of a worker process, see init_worker().
+_worker = {}
+
+
+def init_worker(articles, filter=None):
+    """Set up the preprocessor for run_case() in this process.
+
+    ARTICLES is the list of all (key, text) article definitions in
+    the order they appear in the test files."""
+    settings = TestSettings()
+    _worker["settings"] = settings
+    _worker["preprocessor"] = TestPreprocessor(settings=settings)
+    _worker["articles"] = articles
+    _worker["registered"] = 0
+    _worker["filter"] = filter
+
+
+def run_case(job):
+    """Run one test case after registering all articles that precede
+    it in the test files, and return its result dictionary."""
+    case, n_articles = job
+    settings = _worker["settings"]
+    registered = _worker["registered"]
+    if n_articles < registered:
+        # Later definitions may have replaced earlier ones.
+        settings.templates.clear()
+        registered = 0
+    for key, text in _worker["articles"][registered:n_articles]:
+        settings.templates[key] = text
+    _worker["registered"] = n_articles
+
+    test = Test(case, preprocessor=_worker["preprocessor"])
+    filter = _worker["filter"]
+    if filter is not None and filter.match(test.description) is None:
+        test.skip()
+    elif "disabled" in test.options:
+        test.skip()
+    elif "pst" in test.options or "msg" in test.options or "subpage" in test.options:
+        test.skip()
+    else:
+        test.run()
+    return test.as_dict()
+
+
+def main(default_dir, output_file, filter=None, jobs=1):
     directory = default_dir
     files = os.listdir(directory)
     files.sort()
 
     settings = TestSettings()
-    preprocessor = TestPreprocessor(settings=settings)
 
-    tests = []
+    # Collect all cases first, so they can be distributed over
+    # several processes.  Articles are registered cumulatively.
+    articles = []
+    groups = []
     for filename in files:
         if not filename.endswith(".txt"):
             continue
 
         name, _ = os.path.splitext(os.path.basename(filename))
-        print("{name} ...".format(name=name))
         with open(os.path.join(directory, filename), "r") as fh:
             test_data = testspec.load(fh)
 
         test_index = 0
-        results = []
+        jobs_in_file = []
         for case in test_data:
             if case["type"] == "article":
-                ns, pn = preprocessor.settings.canonical_page_name(case["title"])
-                settings.templates[(ns.prefix, pn)] = case["text"]
+                ns, pn = settings.canonical_page_name(case["title"])
+                articles.append(((ns.prefix, pn), case["text"]))
             else:
                 test_index = test_index + 1
                 case["index"] = test_index
-                test = Test(case, preprocessor=preprocessor)
-                if filter is not None and filter.match(test.description) is None:
-                    result = test.skip()
-                elif "disabled" in test.options:
-                    result = test.skip()
-                elif "disabled" in test.options:
-                    result = test.skip()
-                elif "pst" in test.options or "msg" in test.options or "subpage" in test.options:
-                    result = test.skip()
-                else:
-                    print("{name}[{nr:04}]".format(name=name, nr=test_index), end="", file=sys.stderr)
-                    test.run()
-                    print(" {status}: {description}".format(status=test.status.upper(), description=test.description), file=sys.stderr)
-                results.append(test.as_dict())
+                jobs_in_file.append((case, len(articles)))
+        groups.append((name, jobs_in_file))
+
+    all_jobs = [job for name, jobs_in_file in groups for job in jobs_in_file]
+    if jobs > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs, init_worker, (articles, filter))
+        # imap returns the results in order, so the report and the
+        # progress output are the same as for a serial run.
+        chunksize = max(1, min(32, len(all_jobs) // (jobs * 8)))
+        results_iter = pool.imap(run_case, all_jobs, chunksize)
+    else:
+        pool = None
+        init_worker(articles, filter)
+        results_iter = (run_case(job) for job in all_jobs)
+
+    tests = []
+    for name, jobs_in_file in groups:
+        print("{name} ...".format(name=name))
+        results = []
+        for _ in jobs_in_file:
+            result = next(results_iter)
+            if result["status"] != "skip":
+                print("{name}[{nr:04}] {status}: {description}".format(
+                    name=name, nr=result["index"], status=result["status"].upper(),
+                    description=result["description"]), file=sys.stderr)
+            results.append(result)
         test_group = OrderedDict()
         test_group["filename"] = name
         test_group["results"] = results
         tests.append(test_group)
 
+    if pool is not None:
+        pool.close()
+        pool.join()
+
     with open(output_file, "w") as fh:
         json.dump(tests, fh, indent=2)
 
 
 if __name__ == "__main__":
+    import argparse
+    argparser = argparse.ArgumentParser(description="Run the parser tests.")
+    argparser.add_argument("filter", metavar="REGEX", nargs="?",
+                           help="only run tests whose description matches REGEX")
+    argparser.add_argument("-j", metavar="N", dest="jobs", type=int, default=1,
+                           help="run tests in N processes")
+    args = argparser.parse_args()
+
     test_dir = os.path.dirname(__file__)
     data_dir = os.path.join(test_dir, "data")
     outfile = os.path.join(test_dir, "out", "report.dat")
     filter = None
-    if len(sys.argv) > 1:
-        filter = re.compile(sys.argv[1])
-    main(default_dir=data_dir, output_file=outfile, filter=filter)
+    if args.filter is not None:
+        filter = re.compile(args.filter)
+    main(default_dir=data_dir, output_file=outfile, filter=filter, jobs=args.jobs)
@@ -0,0 +1,255 @@
+#!/usr/bin/env python2.7
+# Copyright 2013 semantics GmbH
+# Written by Marcus Brinkmann <m.brinkmann@semantics.de>
+
+"""Measure how render time and memory scale on adversarial inputs.
+
+Every case generates inputs of increasing size and renders them with
+smc.mw.mediawiki() or Preprocessor.expand() in a child process, which
+is killed if it overruns.  The growth exponent is the slope of
+log(cost) over log(size); cases that grow faster than linear are
+flagged."""
+
+from __future__ import print_function, division
+from __future__ import absolute_import, unicode_literals
+
+import sys
+import json
+import math
+import argparse
+import resource
+import multiprocessing
+from collections import OrderedDict
+from timeit import default_timer
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+from smc import mw
+
+# Samples faster than this are mostly noise and are ignored for the
+# growth estimate.
+MIN_TIME = 0.005
+# The growth is estimated from the largest samples only, as the fixed
+# cost of setting up the parsers dominates small inputs.
+GROWTH_SAMPLES = 3
+
+
+class CasePreprocessor(mw.Preprocessor):
+    def __init__(self, templates, *args, **kwargs):
+        super(CasePreprocessor, self).__init__(*args, **kwargs)
+        self.templates = templates
+
+    def get_template(self, namespace, pagename):
+        if namespace.prefix != "template":
+            return None
+        return self.templates.get(pagename, None)
+
+
+def _nested_templates(n):
+    return "{{Id|" * n + "x" + "}}" * n
+
+
+def _unclosed_braces(n):
+    return "a {{" * n + "b"
+
+
+def _unclosed_links(n):
+    return "a [[" * n + "b"
+
+
+def _unclosed_quotes(n):
+    return "a ''b " * n
+
+
+def _equals_line(n):
+    return "=" * n + "x" + "=" * (n - 1)
+
+
+def _big_table(n):
+    return "{|\n" + "|-\n| a || ''b'' || [[c]]\n" * n + "|}\n"
+
+
+def _many_refs(n):
+    return "".join("x<ref>note %d</ref> " % i for i in range(n)) + "\n\n<references/>\n"
+
+
+def _switch_chain(n):
+    return ("{{#switch:k%d|" % (n - 1)
+            + "|".join("k%d=%d" % (i, i) for i in range(n)) + "}}")
+
+
+def _long_paragraph(n):
+    return "Lorem ipsum dolor sit amet, ''consectetur'' adipisici. " * n
+
+
+# name: (generator, stage, templates, sizes)
+CASES = OrderedDict([
+    ("nested-templates", (_nested_templates, "preprocessor",
+                          {"Id": "{{{1}}}"}, [16, 32, 64, 128, 256])),
+    ("unclosed-braces", (_unclosed_braces, "mediawiki", None,
+                         [4, 8, 16, 32, 64, 128])),
+    ("unclosed-links", (_unclosed_links, "mediawiki", None,
+                        [2, 4, 8, 16, 32, 64])),
+    ("unclosed-quotes", (_unclosed_quotes, "mediawiki", None,
+                         [8, 16, 32, 64, 128, 256])),
+    ("equals-line", (_equals_line, "mediawiki", None,
+                     [8, 16, 32, 64, 128, 256])),
+    ("big-table", (_big_table, "mediawiki", None,
+                   [16, 32, 64, 128, 256])),
+    ("many-refs", (_many_refs, "mediawiki", None,
+                   [16, 32, 64, 128, 256, 512])),
+    ("switch-chain", (_switch_chain, "preprocessor", None,
+                      [64, 128, 256, 512, 1024, 2048])),
+    ("long-paragraph", (_long_paragraph, "mediawiki", None,
+                        [8, 16, 32, 64, 128, 256])),
+])
+
+
+def _maxrss():
+    # Kilobytes on Linux, bytes on Mac OS X.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        rss = rss // 1024
+    return rss
+
+
+def _measure(case, size, queue):
+    generator, stage, templates, _ = CASES[case]
+    text = generator(size)
+    rss_before = _maxrss()
+    start = default_timer()
+    error = None
+    try:
+        if stage == "preprocessor":
+            CasePreprocessor(templates or {}).expand(None, text)
+        else:
+            mw.mediawiki(text)
+    except Exception as exc:
+        # Usually the recursion limit (RuntimeError).
+        error = exc.__class__.__name__
+    elapsed = default_timer() - start
+    queue.put({"size": size, "length": len(text), "time": elapsed,
+               "rss": _maxrss() - rss_before, "error": error})
+
+
+def measure(case, size, timeout):
+    """Render one input in a child process, with a hard timeout."""
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_measure, args=(case, size, queue))
+    proc.start()
+    proc.join(timeout)
+    if proc.is_alive():
+        proc.terminate()
+        proc.join()
+        error = "timeout"
+    else:
+        try:
+            return queue.get(timeout=5)
+        except Empty:
+            # The child crashed or was killed (negative exit code).
+            error = "crash (exit code {0})".format(proc.exitcode)
+    return {"size": size, "length": None, "time": None, "rss": None,
+            "error": error}
+
+
+def growth(samples, key):
+    """Least-squares slope of log(key) over log(input length)."""
+    samples = [s for s in samples if s["error"] is None]
+    if key == "time":
+        samples = [s for s in samples if s["time"] >= MIN_TIME]
+    samples = samples[-GROWTH_SAMPLES:]
+    # Memory deltas can be zero for small inputs.
+    floor = 1 if key == "rss" else MIN_TIME
+    points = [(math.log(s["length"]), math.log(max(s[key], floor)))
+              for s in samples]
+    if len(points) < 2:
+        return None
+    n = len(points)
+    mean_x = sum(x for x, y in points) / n
+    mean_y = sum(y for x, y in points) / n
+    var_x = sum((x - mean_x) ** 2 for x, y in points)
+    if var_x == 0:
+        return None
+    cov = sum((x - mean_x) * (y - mean_y) for x, y in points)
+    return cov / var_x
+
+
+def run_case(case, timeout, max_size=None):
+    samples = []
+    for size in CASES[case][3]:
+        if max_size is not None and size > max_size:
+            break
+        sample = measure(case, size, timeout)
+        samples.append(sample)
+        if sample["error"] is not None:
+            # Larger inputs will not do any better.
+            break
+    return samples
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Measure scaling on pathological inputs.")
+    parser.add_argument("-c", metavar="CASE", dest="cases", action="append",
+                        choices=list(CASES.keys()),
+                        help="only run CASE (may be given several times)")
+    parser.add_argument("--timeout", metavar="SECONDS", type=float, default=20.0,
+                        help="abort a single render after SECONDS")
+    parser.add_argument("--max-size", metavar="N", type=int, dest="max_size",
+                        help="skip sizes larger than N")
+    parser.add_argument("--threshold", metavar="EXP", type=float, default=1.25,
+                        help="flag cases whose growth exponent exceeds EXP")
+    parser.add_argument("--strict", action="store_true", default=False,
+                        help="exit with an error if any case is flagged")
+    parser.add_argument("-o", metavar="OUTFILE", dest="output",
+                        help="write all samples as JSON to OUTFILE")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    cases = args.cases or list(CASES.keys())
+    results = OrderedDict()
+    flagged = []
+    for case in cases:
+        samples = run_case(case, args.timeout, max_size=args.max_size)
+        time_exp = growth(samples, "time")
+        rss_exp = growth(samples, "rss")
+        reasons = [s["error"] for s in samples if s["error"] is not None]
+        if ((time_exp is not None and time_exp > args.threshold)
+                or (rss_exp is not None and rss_exp > args.threshold)):
+            reasons.append("superlinear")
+        if reasons:
+            flagged.append(case)
+        results[case] = {"samples": samples, "time_exponent": time_exp,
+                         "rss_exponent": rss_exp, "flagged": reasons}
+
+        for sample in samples:
+            if sample["time"] is None:
+                print("{case:18} n={size:<6} {error}".format(case=case, **sample))
+                continue
+            print("{case:18} n={size:<6} len={length:<7} {msecs:10.1f} msecs {rss:8} KB {error}".format(
+                case=case, msecs=sample["time"] * 1000, size=sample["size"],
+                length=sample["length"], rss=sample["rss"],
+                error=sample["error"] or ""))
+
+        def _fmt(exp):
+            return "n/a" if exp is None else "{0:.2f}".format(exp)
+        print("{case:18} growth: time {time} memory {rss} {flag}".format(
+            case=case, time=_fmt(time_exp), rss=_fmt(rss_exp),
+            flag=" ".join(reasons).upper()))
+
+    if args.output is not None:
+        with open(args.output, "w") as fh:
+            json.dump(results, fh, indent=2)
+
+    if flagged:
+        print("flagged: " + ", ".join(flagged))
+        if args.strict:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()